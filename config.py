@@ -44,9 +44,130 @@ DATABASE_BACKUP_TIME = int(
 # Time delay in seconds before retrying after a Telegram API floodwait error
 SLEEP_THRESHOLD = int(os.getenv("SLEEP_THRESHOLD", 60))  # Default to 60 seconds
 
+# Startup message sent to the storage channel: "summary" (one message once every client is up), "each" or "none"
+STARTUP_MESSAGE = os.getenv("STARTUP_MESSAGE", "summary").lower()  # Default to "summary"
+
+# Directory of the Pyrogram session files and media DC auth keys, kept across restarts unlike ./cache
+SESSION_DIR = os.getenv("SESSION_DIR", "./sessions")  # Default to ./sessions
+
+# File with extra bot tokens and session strings (one per line), watched so clients can be added or removed while running
+CLIENTS_FILE = os.getenv("CLIENTS_FILE", "./clients.txt")  # Default to ./clients.txt
+
+# Interval in seconds at which CLIENTS_FILE is checked for changes
+CLIENTS_FILE_INTERVAL = int(
+    os.getenv("CLIENTS_FILE_INTERVAL", 30)
+)  # Default to 30 seconds
+
+# Maximum time in seconds a removed client is given to finish its streams and uploads before it is stopped
+CLIENT_DRAIN_TIMEOUT = int(
+    os.getenv("CLIENT_DRAIN_TIMEOUT", 10 * 60)
+)  # Default to 10 minutes
+
+# Directory the pending upload and URL import jobs are stored in, so they resume after a restart
+JOBS_DIR = os.getenv("JOBS_DIR", "./jobs")  # Default to ./jobs
+
+# Maximum number of uploads and URL imports running at once, the others wait in the job queue
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 4))  # Default to 4 jobs
+
+# Maximum number of uploads every client sends to Telegram at once
+UPLOADS_PER_CLIENT = int(os.getenv("UPLOADS_PER_CLIENT", 2))  # Default to 2 uploads
+
+# Times a failed upload or URL import job is run before it is given up
+JOB_ATTEMPTS = int(os.getenv("JOB_ATTEMPTS", 3))  # Default to 3 attempts
+
+# Number of upload sessions the parts of a big file are sent over in parallel
+UPLOAD_SESSIONS = int(os.getenv("UPLOAD_SESSIONS", 4))  # Default to 4 sessions
+
+# Stream uploads from the browser straight to Telegram instead of saving them to ./cache first
+STREAM_UPLOADS = (
+    os.getenv("STREAM_UPLOADS", "false").lower() == "true"
+)  # Default to false
+
+# Maximum size in MBs of the received parts waiting for Telegram in every streamed upload
+UPLOAD_STREAM_BUFFER = (
+    int(os.getenv("UPLOAD_STREAM_BUFFER", 16)) * 1024 * 1024
+)  # Default to 16 MB
+
+# Link files whose content was uploaded before to the stored message instead of uploading them again
+DEDUPLICATE_UPLOADS = (
+    os.getenv("DEDUPLICATE_UPLOADS", "true").lower() == "true"
+)  # Default to true
+
+# Size in MBs of the chunks the website uploads files in, chunks can be resumed after a dropped connection
+UPLOAD_CHUNK_SIZE = (
+    int(os.getenv("UPLOAD_CHUNK_SIZE", 8)) * 1024 * 1024
+)  # Default to 8 MB
+
+# Number of chunks the website uploads in parallel
+UPLOAD_CHUNK_CONCURRENCY = int(
+    os.getenv("UPLOAD_CHUNK_CONCURRENCY", 4)
+)  # Default to 4 chunks
+
 # Domain to auto-ping and keep the website active
 WEBSITE_URL = os.getenv("WEBSITE_URL", None)
 
+# Number of Telegram file parts (1 MB each) requested in parallel for every stream
+STREAM_PREFETCH_PARTS = int(os.getenv("STREAM_PREFETCH_PARTS", 4))  # Default to 4 parts
+
+# Maximum size in MBs of the parts buffered ahead of the client for every stream
+STREAM_MAX_BUFFER = (
+    int(os.getenv("STREAM_MAX_BUFFER", 8)) * 1024 * 1024
+)  # Default to 8 MB
+
+# Number of bot clients the parts of a single stream are spread across, 1 disables striping
+STREAM_STRIPE_CLIENTS = int(os.getenv("STREAM_STRIPE_CLIENTS", 1))  # Default to 1 client
+
+# Maximum number of media sessions opened by every client for every Telegram DC
+MEDIA_SESSIONS_PER_DC = int(os.getenv("MEDIA_SESSIONS_PER_DC", 4))  # Default to 4 sessions
+
+# Requests in flight on every media session before another session is opened for the DC
+MEDIA_SESSION_MAX_LOAD = int(os.getenv("MEDIA_SESSION_MAX_LOAD", 4))  # Default to 4 requests
+
+# Interval in seconds at which media sessions for the DCs of the drive files are opened ahead of streams and checked, 0 disables it
+MEDIA_SESSION_CHECK_INTERVAL = int(
+    os.getenv("MEDIA_SESSION_CHECK_INTERVAL", 60)
+)  # Default to 60 seconds
+
+# Number of times a failed file part is requested again before a stream is aborted
+STREAM_MAX_RETRIES = int(os.getenv("STREAM_MAX_RETRIES", 5))  # Default to 5 retries
+
+# Disk space in GBs used to cache streamed file parts, 0 disables the chunk cache
+CHUNK_CACHE_SIZE = int(
+    float(os.getenv("CHUNK_CACHE_SIZE", 0)) * 1024 * 1024 * 1024
+)  # Default to 0 (disabled)
+
+# Directory of the chunk cache, kept across restarts unlike ./cache
+CHUNK_CACHE_DIR = os.getenv("CHUNK_CACHE_DIR", "./chunk_cache")
+
+# Memory in MBs used to keep the most recently streamed file parts, 0 disables the hot part cache
+HOT_PART_CACHE_SIZE = (
+    int(os.getenv("HOT_PART_CACHE_SIZE", 32)) * 1024 * 1024
+)  # Default to 32 MB
+
+# Maximum number of resolved Telegram file ids kept in memory, shared by all clients
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", 1000))  # Default to 1000 files
+
+# Time in seconds a resolved Telegram file id is kept in memory
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL", 6 * 60 * 60))  # Default to 6 hours
+
+# Concurrent GetFile requests of every client, shared fairly between the open streams
+GETFILE_SLOTS_PER_CLIENT = int(
+    os.getenv("GETFILE_SLOTS_PER_CLIENT", 16)
+)  # Default to 16 requests
+
+# Bandwidth ceiling in MBs per second of all streams opened from shared folder links, 0 disables it
+SHARED_LINK_RATE_LIMIT = (
+    int(os.getenv("SHARED_LINK_RATE_LIMIT", 0)) * 1024 * 1024
+)  # Default to 0 (unlimited)
+
+# Disk space in MBs used to cache Telegram thumbnails served by /thumb, 0 disables the cache
+THUMB_CACHE_SIZE = (
+    int(os.getenv("THUMB_CACHE_SIZE", 64)) * 1024 * 1024
+)  # Default to 64 MB
+
+# Directory of the thumbnail cache, kept across restarts
+THUMB_CACHE_DIR = os.getenv("THUMB_CACHE_DIR", "./thumb_cache")
+
 
 # For Using TG Drive's Bot Mode
 
@@ -1,19 +1,28 @@
-from utils.downloader import (
-    download_file,
-    get_file_info_from_url,
-)
-import asyncio
+from utils.downloader import get_file_info_from_url
+import asyncio, hashlib
 from pathlib import Path
 from contextlib import asynccontextmanager
 import aiofiles
 from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Form, Response
 from fastapi.responses import FileResponse, JSONResponse
-from config import ADMIN_PASSWORD, MAX_FILE_SIZE, STORAGE_CHANNEL
+from starlette.requests import ClientDisconnect
+from config import (
+    ADMIN_PASSWORD,
+    MAX_FILE_SIZE,
+    STORAGE_CHANNEL,
+    STREAM_UPLOADS,
+    UPLOAD_CHUNK_CONCURRENCY,
+)
+from utils.chunked_upload import CHUNKED_UPLOADS
 from utils.clients import initialize_clients
+from utils.content_hash import get_sha256_key
 from utils.directoryHandler import getRandomID
 from utils.extra import auto_ping_website, convert_class_to_dict, reset_cache_dir
 from utils.streamer import media_streamer
-from utils.uploader import start_file_uploader
+from utils.streamer.session_pool import warm_session_pools
+from utils.streamer.thumbnails import get_thumbnails, thumb_response
+from utils.streamer.zip_stream import zip_streamer
+from utils.job_queue import JOB_QUEUE, submit_download, submit_upload
 from utils.logger import Logger
 import urllib.parse
 
@@ -27,6 +36,15 @@ async def lifespan(app: FastAPI):
     # Initialize the clients
     await initialize_clients()
 
+    # Start the transfer job queue, resuming the jobs left by the previous run
+    JOB_QUEUE.start()
+
+    # Load the chunked uploads the website can resume
+    CHUNKED_UPLOADS.start()
+
+    # Open the media sessions for the DCs of the drive files ahead of the first streams
+    asyncio.create_task(warm_session_pools())
+
     # Start the website auto ping task
     asyncio.create_task(auto_ping_website())
 
@@ -53,17 +71,46 @@ async def static_files(file_path):
         with open(Path("website/static/js/apiHandler.js")) as f:
             content = f.read()
             content = content.replace("MAX_FILE_SIZE__SDGJDG", str(MAX_FILE_SIZE))
+            content = content.replace(
+                "STREAM_UPLOADS__SDGJDG", "true" if STREAM_UPLOADS else "false"
+            )
+            content = content.replace(
+                "UPLOAD_CHUNK_CONCURRENCY__SDGJDG", str(UPLOAD_CHUNK_CONCURRENCY)
+            )
         return Response(content=content, media_type="application/javascript")
     return FileResponse(f"website/static/{file_path}")
 
 
-@app.get("/file")
+@app.api_route("/file", methods=["GET", "HEAD"])
 async def dl_file(request: Request):
     from utils.directoryHandler import DRIVE_DATA
 
     path = request.query_params["path"]
     file = DRIVE_DATA.get_file(path)
-    return await media_streamer(STORAGE_CHANNEL, file.file_id, file.name, request)
+    return await media_streamer(STORAGE_CHANNEL, file, request)
+
+
+@app.get("/thumb")
+async def dl_thumb(request: Request):
+    from utils.directoryHandler import DRIVE_DATA
+
+    path = request.query_params["path"]
+    file = DRIVE_DATA.get_file(path)
+    return await thumb_response(STORAGE_CHANNEL, file, request)
+
+
+@app.get("/zip")
+async def dl_zip(request: Request):
+    from utils.directoryHandler import DRIVE_DATA
+
+    path = request.query_params["path"]
+    folder = DRIVE_DATA.get_directory(path)
+
+    # The root folder path is guessable, archiving the whole drive needs the admin password
+    if folder.name == "/" and request.query_params.get("password") != ADMIN_PASSWORD:
+        raise HTTPException(status_code=403, detail="Invalid password")
+
+    return await zip_streamer(STORAGE_CHANNEL, folder)
 
 
 # Api Routes
@@ -146,6 +193,26 @@ async def api_get_directory(request: Request):
     return JSONResponse({"status": "ok", "data": folder_data, "auth_home_path": None})
 
 
+@app.post("/api/getThumbnails")
+async def api_get_thumbnails(request: Request):
+    from utils.directoryHandler import DRIVE_DATA
+
+    # Like /thumb and /file this needs no password, shared folders show thumbnails too
+    data = await request.json()
+
+    files = []
+    for path in data["paths"]:
+        try:
+            file = DRIVE_DATA.get_file(path)
+        except (KeyError, AttributeError):
+            continue
+        if file.type == "file":
+            files.append((path, file))
+
+    thumbnails = await get_thumbnails(STORAGE_CHANNEL, files, data.get("size"))
+    return JSONResponse({"status": "ok", "data": thumbnails})
+
+
 SAVE_PROGRESS = {}
 
 
@@ -172,11 +239,14 @@ async def upload_file(
     file_location = cache_dir / f"{id}.{ext}"
 
     file_size = 0
+    # Hashed while it is saved, an identical file uploaded before is not uploaded again
+    hasher = hashlib.sha256()
 
     async with aiofiles.open(file_location, "wb") as buffer:
         while chunk := await file.read(1024 * 1024):  # Read file in chunks of 1MB
             SAVE_PROGRESS[id] = ("running", file_size, total_size)
             file_size += len(chunk)
+            hasher.update(chunk)
             if file_size > MAX_FILE_SIZE:
                 await buffer.close()
                 file_location.unlink()  # Delete the partially written file
@@ -188,13 +258,129 @@ async def upload_file(
 
     SAVE_PROGRESS[id] = ("completed", file_size, file_size)
 
-    asyncio.create_task(
-        start_file_uploader(file_location, id, path, file.filename, file_size)
+    submit_upload(
+        file_location,
+        id,
+        path,
+        file.filename,
+        file_size,
+        content_hash=get_sha256_key(hasher),
     )
 
     return JSONResponse({"id": id, "status": "ok"})
 
 
+@app.post("/api/uploadStream")
+async def upload_file_stream(request: Request):
+    from utils.uploader import stream_file_uploader
+
+    # The body is the raw file, so the other fields are passed in the query string
+    # and the password in a header, query strings end up in access logs
+    params = request.query_params
+
+    if request.headers.get("X-Password") != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    id = params["id"]
+    total_size = int(params["total_size"])
+    if total_size > MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"File size exceeds {MAX_FILE_SIZE} bytes limit",
+        )
+
+    try:
+        await stream_file_uploader(
+            request.stream(), id, params["path"], params["filename"], total_size
+        )
+    except ClientDisconnect:
+        logger.info(f"Streamed upload {id} canceled by the client")
+        return Response(status_code=499)
+    except Exception as e:
+        logger.error(f"Streamed upload {id} failed: {e!r}")
+        return JSONResponse({"status": str(e)})
+
+    return JSONResponse({"id": id, "status": "ok"})
+
+
+@app.post("/api/uploadInit")
+async def upload_init(request: Request):
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    logger.info(f"uploadInit {data}")
+    try:
+        upload = CHUNKED_UPLOADS.create(
+            data.get("id"), data["path"], data["filename"], int(data["size"])
+        )
+        return JSONResponse({"status": "ok", **upload.status()})
+    except Exception as e:
+        return JSONResponse({"status": str(e)})
+
+
+@app.put("/api/uploadChunk")
+async def upload_chunk(request: Request):
+    # The body is the raw chunk, so the other fields are passed in the query string
+    # and the password in a header, like /api/uploadStream
+    params = request.query_params
+
+    if request.headers.get("X-Password") != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    try:
+        await CHUNKED_UPLOADS.write_chunk(
+            params["id"], int(params["index"]), request.stream()
+        )
+    except ClientDisconnect:
+        return Response(status_code=499)
+    except Exception as e:
+        logger.warning(
+            f"Chunk {params.get('index')} of upload {params.get('id')} failed: {e}"
+        )
+        return JSONResponse({"status": str(e)}, status_code=400)
+
+    return JSONResponse({"status": "ok"})
+
+
+@app.post("/api/uploadStatus")
+async def upload_status(request: Request):
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    try:
+        upload = CHUNKED_UPLOADS.get_upload(data["id"])
+        return JSONResponse({"status": "ok", **upload.status()})
+    except Exception as e:
+        return JSONResponse({"status": str(e)})
+
+
+@app.post("/api/uploadFinalize")
+async def upload_finalize(request: Request):
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    logger.info(f"uploadFinalize {data}")
+    try:
+        upload = CHUNKED_UPLOADS.finalize(data["id"])
+    except Exception as e:
+        return JSONResponse({"status": str(e)})
+
+    submit_upload(
+        upload.file_path,
+        upload.id,
+        upload.directory_path,
+        upload.filename,
+        upload.file_size,
+    )
+    return JSONResponse({"id": upload.id, "status": "ok"})
+
+
 @app.post("/api/getSaveProgress")
 async def get_save_progress(request: Request):
     global SAVE_PROGRESS
@@ -243,6 +429,8 @@ async def cancel_upload(request: Request):
     logger.info(f"cancelUpload {data}")
     STOP_TRANSMISSION.append(data["id"])
     STOP_DOWNLOAD.append(data["id"])
+    JOB_QUEUE.cancel_transfer(data["id"])
+    CHUNKED_UPLOADS.cancel(data["id"])
     return JSONResponse({"status": "ok"})
 
 
@@ -365,8 +553,13 @@ async def startFileDownloadFromUrl(request: Request):
     logger.info(f"startFileDownloadFromUrl {data}")
     try:
         id = getRandomID()
-        asyncio.create_task(
-            download_file(data["url"], id, data["path"], data["filename"], data["singleThreaded"])
+        submit_download(
+            data["url"],
+            id,
+            data["path"],
+            data["filename"],
+            data["singleThreaded"],
+            priority=int(data.get("priority", 0)),
         )
         return JSONResponse({"status": "ok", "id": id})
     except Exception as e:
@@ -391,6 +584,113 @@ async def getFileDownloadProgress(request: Request):
         return JSONResponse({"status": "not found"})
 
 
+@app.post("/api/getStreamQueue")
+async def getStreamQueue(request: Request):
+    from utils.streamer.file_id_cache import FILE_ID_CACHE
+    from utils.streamer.scheduler import STREAM_SCHEDULER
+
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    return JSONResponse(
+        {
+            "status": "ok",
+            "data": {
+                **STREAM_SCHEDULER.stats(),
+                "file_id_cache": FILE_ID_CACHE.stats(),
+            },
+        }
+    )
+
+
+@app.post("/api/getClientHealth")
+async def getClientHealth(request: Request):
+    from utils.clients import get_clients_health
+
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    return JSONResponse({"status": "ok", "data": get_clients_health()})
+
+
+@app.post("/api/addClient")
+async def addClient(request: Request):
+    from utils.clients import add_client
+
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    try:
+        client_id = await add_client(data["token"])
+        return JSONResponse({"status": "ok", "client": client_id})
+    except Exception as e:
+        return JSONResponse({"status": str(e)})
+
+
+@app.post("/api/removeClient")
+async def removeClient(request: Request):
+    from utils.clients import drain_client, stop_drained_client
+
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    try:
+        client_id = int(data["client"])
+        drain_client(client_id)
+    except Exception as e:
+        return JSONResponse({"status": str(e)})
+
+    # The client is stopped once its streams are done, getClientHealth shows it draining
+    asyncio.create_task(stop_drained_client(client_id, data.get("timeout")))
+    return JSONResponse({"status": "ok"})
+
+
+@app.post("/api/getJobs")
+async def getJobs(request: Request):
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    return JSONResponse({"status": "ok", "data": JOB_QUEUE.list_jobs()})
+
+
+@app.post("/api/setJobPriority")
+async def setJobPriority(request: Request):
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    try:
+        JOB_QUEUE.set_priority(data["id"], int(data["priority"]))
+        return JSONResponse({"status": "ok"})
+    except Exception as e:
+        return JSONResponse({"status": str(e)})
+
+
+@app.post("/api/cancelJob")
+async def cancelJob(request: Request):
+    data = await request.json()
+
+    if data["password"] != ADMIN_PASSWORD:
+        return JSONResponse({"status": "Invalid password"})
+
+    try:
+        JOB_QUEUE.cancel(data["id"])
+        return JSONResponse({"status": "ok"})
+    except Exception as e:
+        return JSONResponse({"status": str(e)})
+
+
 @app.post("/api/getFolderShareAuth")
 async def getFolderShareAuth(request: Request):
     from utils.directoryHandler import DRIVE_DATA
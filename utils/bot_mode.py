@@ -3,7 +3,9 @@ import json
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 import config
+from utils.content_hash import find_duplicate, get_unique_id_key
 from utils.logger import Logger
+from utils.streamer.file_properties import get_media_properties
 from pathlib import Path
 
 logger = Logger(f"{__name__}")
@@ -25,8 +27,8 @@ SET_FOLDER_PATH_CACHE = {}
 DRIVE_DATA = None
 BOT_MODE = None 
 
-session_cache_path = Path(f"./cache")
-session_cache_path.parent.mkdir(parents=True, exist_ok=True)
+session_dir = Path(config.SESSION_DIR) / (config.MAIN_BOT_TOKEN or "main").split(":")[0]
+session_dir.mkdir(parents=True, exist_ok=True)
 
 DEFAULT_FOLDER_CONFIG_FILE = Path("./default_folder_config.json")
 
@@ -36,7 +38,7 @@ main_bot = Client(
     api_hash=config.API_HASH,
     bot_token=config.MAIN_BOT_TOKEN,
     sleep_threshold=config.SLEEP_THRESHOLD,
-    workdir=session_cache_path,
+    workdir=session_dir,
 )
 
 # --- Manual 'ask' implementation setup ---
@@ -312,7 +314,15 @@ async def file_handler(client: Client, message: Message):
         )
         return
 
-    copied_message = await message.copy(config.STORAGE_CHANNEL)
+    # Files the bot received before keep their Telegram unique id, they are linked to the
+    # stored message instead of being copied to the storage channel again
+    unique_id_key = get_unique_id_key(message)
+    copied_message = await find_duplicate([unique_id_key])
+    if copied_message is None:
+        copied_message = await message.copy(config.STORAGE_CHANNEL)
+    else:
+        logger.info(f"Linked {unique_id_key} to the stored message {copied_message.id}")
+
     file = (
         copied_message.document
         or copied_message.video
@@ -326,6 +336,8 @@ async def file_handler(client: Client, message: Message):
         file.file_name,
         copied_message.id,
         file.file_size,
+        **get_media_properties(copied_message),
+        hashes=[unique_id_key],
     )
 
     await message.reply_text(
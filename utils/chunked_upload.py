@@ -0,0 +1,252 @@
+import aiofiles, config, json, math, os, time
+from pathlib import Path
+from typing import Dict, List, Set
+from utils.directoryHandler import getRandomID
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Manifests of the chunked uploads in progress, the chunks are written into the staged file in ./cache
+UPLOADS_DIR = Path("./cache/uploads")
+
+# Seconds an unfinished chunked upload is kept after its last chunk
+UPLOAD_EXPIRY = 24 * 60 * 60
+
+
+class ChunkedUpload:
+    """
+    A file sent by the website in numbered chunks of chunk_size bytes (the last one may be
+    shorter). Chunks can arrive in any order and any number of times, every chunk is written
+    at its own offset of the staged file, so sending a chunk again is harmless.
+    """
+
+    def __init__(
+        self,
+        id: str,
+        directory_path: str,
+        filename: str,
+        file_size: int,
+        chunk_size: int,
+        received: List[int] = (),
+        updated: float = None,
+    ):
+        self.id = id
+        self.directory_path = directory_path
+        self.filename = filename
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.received: Set[int] = set(received)
+        self.updated = updated or time.time()
+
+    @property
+    def file_path(self) -> Path:
+        ext = self.filename.lower().split(".")[-1]
+        return Path("./cache") / f"{self.id}.{ext}"
+
+    @property
+    def total_chunks(self) -> int:
+        return max(1, math.ceil(self.file_size / self.chunk_size))
+
+    @property
+    def expired(self) -> bool:
+        return time.time() - self.updated > UPLOAD_EXPIRY
+
+    def chunk_length(self, index: int) -> int:
+        if not 0 <= index < self.total_chunks:
+            raise Exception(f"Chunk {index} is out of range")
+        return min(self.chunk_size, self.file_size - index * self.chunk_size)
+
+    def missing_chunks(self) -> List[int]:
+        return [i for i in range(self.total_chunks) if i not in self.received]
+
+    def get_offset(self) -> int:
+        """
+        Bytes received without a gap from the start of the file, like the offset of tus.
+        """
+        index = 0
+        while index in self.received:
+            index += 1
+        return min(index * self.chunk_size, self.file_size)
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "size": self.file_size,
+            "chunk_size": self.chunk_size,
+            "total_chunks": self.total_chunks,
+            "offset": self.get_offset(),
+            "missing": self.missing_chunks(),
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "directory_path": self.directory_path,
+            "filename": self.filename,
+            "file_size": self.file_size,
+            "chunk_size": self.chunk_size,
+            "received": sorted(self.received),
+            "updated": self.updated,
+        }
+
+
+class ChunkedUploads:
+    """
+    The chunked uploads in progress. Their manifests are stored in UPLOADS_DIR next to the
+    staged files, so an upload can be resumed after a dropped connection or a restart.
+    Once every chunk is received the file is handed to the job queue like a regular upload.
+    """
+
+    def __init__(self, uploads_dir: Path):
+        self.uploads_dir = uploads_dir
+        self.uploads: Dict[str, ChunkedUpload] = {}
+
+    def start(self) -> None:
+        """
+        Loads the uploads left unfinished by the previous run, expired ones are deleted.
+        """
+        self.uploads_dir.mkdir(parents=True, exist_ok=True)
+        for upload in load_upload_files(self.uploads_dir):
+            if upload.expired or not upload.file_path.exists():
+                self.discard(upload)
+            else:
+                self.uploads[upload.id] = upload
+
+        if self.uploads:
+            logger.info(f"{len(self.uploads)} chunked uploads can be resumed")
+
+    def create(
+        self, id: str, directory_path: str, filename: str, file_size: int
+    ) -> ChunkedUpload:
+        """
+        Starts an upload, or returns the upload with the given id if it is the same file
+        so the website can resume it.
+        """
+        if file_size > config.MAX_FILE_SIZE:
+            raise Exception(f"File size exceeds {config.MAX_FILE_SIZE} bytes limit")
+
+        self.remove_expired()
+        upload = self.uploads.get(id) if id else None
+        if (
+            upload
+            and upload.directory_path == directory_path
+            and upload.filename == filename
+            and upload.file_size == file_size
+        ):
+            logger.info(f"Resuming chunked upload {id} of {filename}")
+            return upload
+
+        upload = ChunkedUpload(
+            getRandomID(), directory_path, filename, file_size, config.UPLOAD_CHUNK_SIZE
+        )
+        upload.file_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(upload.file_path, "wb") as f:
+            f.truncate(file_size)
+        self.uploads[upload.id] = upload
+        self.save_upload(upload)
+        logger.info(
+            f"Started chunked upload {upload.id} of {filename} in {upload.total_chunks} chunks"
+        )
+        return upload
+
+    def get_upload(self, id: str) -> ChunkedUpload:
+        upload = self.uploads.get(id)
+        if upload is None:
+            raise Exception(f"Upload {id} not found")
+        return upload
+
+    async def write_chunk(self, id: str, index: int, stream) -> ChunkedUpload:
+        """
+        Writes the chunk read from stream at its offset of the staged file. The chunk only
+        counts as received when exactly its length arrived.
+        """
+        upload = self.get_upload(id)
+        length = upload.chunk_length(index)
+
+        written = 0
+        async with aiofiles.open(upload.file_path, "r+b") as f:
+            await f.seek(index * upload.chunk_size)
+            async for data in stream:
+                written += len(data)
+                if written > length:
+                    raise Exception(f"Chunk {index} is larger than {length} bytes")
+                await f.write(data)
+
+        if written != length:
+            raise Exception(f"Chunk {index} has {written} of {length} bytes")
+
+        # The upload may have been canceled while the chunk was being written
+        if self.uploads.get(id) is upload:
+            upload.received.add(index)
+            upload.updated = time.time()
+            self.save_upload(upload)
+        return upload
+
+    def finalize(self, id: str) -> ChunkedUpload:
+        """
+        Ends an upload whose chunks were all received, the staged file is then up to the caller.
+        """
+        upload = self.get_upload(id)
+        missing = upload.missing_chunks()
+        if missing:
+            raise Exception(f"Upload {id} is missing {len(missing)} chunks")
+
+        del self.uploads[id]
+        self.get_manifest_path(upload).unlink(missing_ok=True)
+        return upload
+
+    def cancel(self, id: str) -> None:
+        upload = self.uploads.get(id)
+        if upload:
+            self.discard(upload)
+
+    def discard(self, upload: ChunkedUpload) -> None:
+        self.uploads.pop(upload.id, None)
+        self.get_manifest_path(upload).unlink(missing_ok=True)
+        upload.file_path.unlink(missing_ok=True)
+
+    def remove_expired(self) -> None:
+        for upload in list(self.uploads.values()):
+            if upload.expired:
+                logger.info(f"Chunked upload {upload.id} expired")
+                self.discard(upload)
+
+    def get_manifest_path(self, upload: ChunkedUpload) -> Path:
+        return self.uploads_dir / f"{upload.id}.json"
+
+    def save_upload(self, upload: ChunkedUpload) -> None:
+        path = self.get_manifest_path(upload)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(upload.to_dict()))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to store chunked upload {upload.id}: {e}")
+
+
+def load_upload_files(uploads_dir: Path) -> List[ChunkedUpload]:
+    uploads = []
+    for path in sorted(uploads_dir.glob("*.json")):
+        try:
+            uploads.append(ChunkedUpload(**json.loads(path.read_text())))
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Skipping unreadable upload manifest {path}: {e}")
+    return uploads
+
+
+def get_upload_files() -> Set[Path]:
+    """
+    Returns the manifests directory and the staged files of the unfinished chunked uploads,
+    so the cache reset on startup keeps them.
+    """
+    if not UPLOADS_DIR.exists():
+        return set()
+    files = {UPLOADS_DIR.resolve()}
+    for upload in load_upload_files(UPLOADS_DIR):
+        if not upload.expired:
+            files.add(upload.file_path.resolve())
+    return files
+
+
+CHUNKED_UPLOADS = ChunkedUploads(UPLOADS_DIR)
@@ -0,0 +1,125 @@
+import asyncio, time
+from typing import Dict
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Requests per second and burst of every kind of RPC a client sends, keeps bots under flood limits
+RPC_RATES = {
+    "download": (50, 100),  # upload.GetFile
+    "upload": (2, 4),  # whole file uploads
+    "message": (5, 10),  # fetching, sending and editing messages
+}
+
+# Consecutive errors that take a client out of rotation
+FAILURE_THRESHOLD = 5
+
+# Seconds a failing client stays out of rotation, doubled every time it fails again after a cooldown
+BASE_COOLDOWN = 10
+MAX_COOLDOWN = 5 * 60
+
+
+class TokenBucket:
+    """
+    Paces consumers to rate units per second. A consumer may overdraw the bucket,
+    it then waits until the debt is paid back, so requests larger than the burst still pass.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def consume(self, amount: float) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class ClientHealth:
+    """
+    Health of one client. Its circuit opens on a FloodWait until the wait is over, or after
+    FAILURE_THRESHOLD consecutive errors for a growing cooldown. While the circuit is open
+    the client is skipped when clients are chosen. After a cooldown a single failure opens
+    the circuit again (half open) until a request succeeds.
+    """
+
+    def __init__(self, client: Client):
+        self.name = client.name
+        self.buckets = {kind: TokenBucket(*rate) for kind, rate in RPC_RATES.items()}
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.flood_waits = 0
+        self.errors = 0
+        self.last_error = None
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    @property
+    def cooldown(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    async def pace(self, kind: str) -> None:
+        await self.buckets[kind].consume(1)
+
+    async def wait_available(self) -> None:
+        if self.cooldown:
+            await asyncio.sleep(self.cooldown)
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.trips = 0
+
+    def record_error(self, error: Exception) -> None:
+        self.last_error = repr(error)
+
+        if isinstance(error, FloodWait):
+            self.flood_waits += 1
+            self.trip(error.value, f"FloodWait of {error.value}s")
+            return
+
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= FAILURE_THRESHOLD:
+            self.trip(
+                min(BASE_COOLDOWN * 2**self.trips, MAX_COOLDOWN),
+                f"{self.failures} consecutive errors",
+            )
+            self.trips += 1
+            self.failures = FAILURE_THRESHOLD - 1
+
+    def trip(self, seconds: float, reason: str) -> None:
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+        logger.warning(
+            f"Client {self.name} out of rotation for {self.cooldown:.0f}s: {reason}"
+        )
+
+    def stats(self) -> dict:
+        return {
+            "available": self.available,
+            "cooldown": round(self.cooldown, 1),
+            "flood_waits": self.flood_waits,
+            "errors": self.errors,
+            "consecutive_failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+CLIENT_HEALTH: Dict[str, ClientHealth] = {}
+
+
+def get_health(client: Client) -> ClientHealth:
+    health = CLIENT_HEALTH.get(client.name)
+    if health is None:
+        health = ClientHealth(client)
+        CLIENT_HEALTH[client.name] = health
+    return health
@@ -1,6 +1,8 @@
-import asyncio, config
+import asyncio, config, re, time
 from pathlib import Path
+from typing import List, Optional
 from pyrogram import Client
+from utils.client_health import get_health
 from utils.directoryHandler import backup_drive_data, loadDriveData
 from utils.logger import Logger
 import os
@@ -13,101 +15,536 @@ premium_clients = {}
 work_loads = {}
 premium_work_loads = {}
 main_bot = None
+attach_task: asyncio.Task = None
+
+# Bot token or session string every running client was started from, by client index
+client_tokens = {}
+
+# Highest client index handed out, clients added later never reuse a removed index
+last_client_id = 0
+
+# Clients finishing their leases before they are stopped, they get no new work
+draining_clients = set()
+
+
+async def start_client(client_id: int, token: str, type: str) -> bool:
+    """
+    Starts a bot ("bot") or premium account ("user") client and adds it to the rotation.
+    """
+    global last_client_id
+    last_client_id = max(last_client_id, client_id)
+
+    try:
+        logger.info(f"Starting - {type.title()} Client {client_id}")
+
+        session_dir = Path(config.SESSION_DIR)
+        if type == "bot":
+            # Every bot keeps its session in its own directory under a fixed file name,
+            # so reordering BOT_TOKENS never mixes them up
+            workdir = session_dir / token.split(":")[0]
+            workdir.mkdir(parents=True, exist_ok=True)
+            session_file = workdir / "bot.session"
+            if not session_file.exists():
+                # Sessions stored under the index of the token by older versions
+                for old_session in workdir.glob("*.session"):
+                    old_session.rename(session_file)
+                    break
+            client = Client(
+                name="bot",
+                api_id=config.API_ID,
+                api_hash=config.API_HASH,
+                bot_token=token,
+                workdir=workdir,
+            )
+            # The storage has taken the session file name, the client name keys the
+            # health, upload slots and home DC of the client and must stay unique
+            client.name = str(client_id)
+            client.loop = asyncio.get_running_loop()
+            await client.start()
+        elif type == "user":
+            session_dir.mkdir(parents=True, exist_ok=True)
+            client = await Client(
+                name=str(client_id),
+                api_id=config.API_ID,
+                api_hash=config.API_HASH,
+                session_string=token,
+                sleep_threshold=config.SLEEP_THRESHOLD,
+                workdir=session_dir,
+                no_updates=True,
+            ).start()
+
+        if config.STARTUP_MESSAGE == "each":
+            await client.send_message(
+                config.STORAGE_CHANNEL,
+                f"Started - {type.title()} Client {client_id}",
+            )
+
+        home_dcs[client.name] = await client.storage.dc_id()
+        if type == "bot":
+            multi_clients[client_id] = client
+            work_loads[client_id] = 0
+        else:
+            premium_clients[client_id] = client
+            premium_work_loads[client_id] = 0
+        client_tokens[client_id] = token
+
+        logger.info(f"Started - {type.title()} Client {client_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed To Start {type.title()} Client - {client_id} Error: {e}")
+        return False
 
 
 async def initialize_clients():
-    global multi_clients, work_loads, premium_clients, premium_work_loads
+    """
+    Starts the first bot and loads the drive data so the website can serve right away,
+    the other clients are started in the background and join as they come online.
+    """
+    global multi_clients, work_loads, premium_clients, premium_work_loads, attach_task
     logger.info("Initializing Clients")
 
-    session_cache_path = Path(f"./cache")
-    session_cache_path.parent.mkdir(parents=True, exist_ok=True)
-
     all_tokens = dict((i, t) for i, t in enumerate(config.BOT_TOKENS, start=1))
     all_sessions = dict(
         (i, s) for i, s in enumerate(config.STRING_SESSIONS, start=len(all_tokens) + 1)
     )
 
-    async def start_client(client_id, token, type):
-        try:
-            logger.info(f"Starting - {type.title()} Client {client_id}")
-
-            if type == "bot":
-                client = Client(
-                    name=str(client_id),
-                    api_id=config.API_ID,
-                    api_hash=config.API_HASH,
-                    bot_token=token,
-                    workdir=session_cache_path,
-                )
-                client.loop = asyncio.get_running_loop()
-                await client.start()
-                await client.send_message(
-                    config.STORAGE_CHANNEL,
-                    f"Started - {type.title()} Client {client_id}",
-                )
-                multi_clients[client_id] = client
-                work_loads[client_id] = 0
-            elif type == "user":
-                client = await Client(
-                    name=str(client_id),
-                    api_id=config.API_ID,
-                    api_hash=config.API_HASH,
-                    session_string=token,
-                    sleep_threshold=config.SLEEP_THRESHOLD,
-                    workdir=session_cache_path,
-                    no_updates=True,
-                ).start()
-                await client.send_message(
-                    config.STORAGE_CHANNEL,
-                    f"Started - {type.title()} Client {client_id}",
-                )
-                premium_clients[client_id] = client
-                premium_work_loads[client_id] = 0
+    # One bot is enough to load the drive data and start serving
+    pending_tokens = list(all_tokens.items())
+    while pending_tokens:
+        client_id, token = pending_tokens.pop(0)
+        if await start_client(client_id, token, "bot"):
+            break
 
-            logger.info(f"Started - {type.title()} Client {client_id}")
-        except Exception as e:
-            logger.error(
-                f"Failed To Start {type.title()} Client - {client_id} Error: {e}"
-            )
-
-    await asyncio.gather(
-        *(
-            [
-                start_client(client_id, client, "bot")
-                for client_id, client in all_tokens.items()
-            ]
-            + [
-                start_client(client_id, client, "user")
-                for client_id, client in all_sessions.items()
-            ]
-        )
-    )
     if len(multi_clients) == 0:
         logger.error("No Clients Were Initialized")
 
         # Forcefully terminates the program immediately
         os.kill(os.getpid(), signal.SIGKILL)
 
-    if len(premium_clients) == 0:
-        logger.info("No Premium Clients Were Initialized")
-
-    logger.info("Clients Initialized")
-
     # Load the drive data
     await loadDriveData()
 
     # Start the backup drive data task
     asyncio.create_task(backup_drive_data())
 
+    async def attach_clients():
+        await asyncio.gather(
+            *(
+                [
+                    start_client(client_id, client, "bot")
+                    for client_id, client in pending_tokens
+                ]
+                + [
+                    start_client(client_id, client, "user")
+                    for client_id, client in all_sessions.items()
+                ]
+            )
+        )
+
+        if len(premium_clients) == 0:
+            logger.info("No Premium Clients Were Initialized")
+
+        logger.info(
+            f"Clients Initialized - {len(multi_clients)} Bot, "
+            f"{len(premium_clients)} Premium"
+        )
+
+        if config.STARTUP_MESSAGE == "summary":
+            try:
+                await get_client().send_message(
+                    config.STORAGE_CHANNEL,
+                    f"Started - {len(multi_clients)} Bot Clients, "
+                    f"{len(premium_clients)} Premium Clients",
+                )
+            except Exception as e:
+                logger.warning(f"Failed to send the startup message: {e}")
+
+        # Clients listed in the clients file join once the configured ones are up
+        asyncio.create_task(watch_clients_file())
+
+    attach_task = asyncio.create_task(attach_clients())
+
+
+async def wait_for_clients() -> None:
+    """
+    Waits until the clients started in the background have come online or failed.
+    """
+    if attach_task is not None:
+        await asyncio.shield(attach_task)
+
+
+# Weight of the newest sample in the per-client RPC latency average
+LATENCY_EWMA_ALPHA = 0.2
+
+# Latency assumed for clients without samples yet
+DEFAULT_LATENCY = 0.25
+
+# Bytes in flight counted as one more operation when weighing client load
+BYTES_PER_OPERATION = 64 * 1024 * 1024
+
+# Round trips of exporting and importing an authorization, paid by the first request
+# of a client to a DC it has no media session for
+COLD_SESSION_ROUND_TRIPS = 4
+
+client_latency = {}
+bytes_in_flight = {}
+
+# Home DC and DCs with an open media session of every client, by client name
+home_dcs = {}
+warm_dcs = {}
+
+
+def record_latency(client: Client, seconds: float) -> None:
+    """
+    Adds an RPC round trip time to the latency average of the client.
+    """
+    # Clients are named after their index in work_loads
+    previous = client_latency.get(client.name)
+    if previous is None:
+        client_latency[client.name] = seconds
+    else:
+        client_latency[client.name] = previous + LATENCY_EWMA_ALPHA * (
+            seconds - previous
+        )
+
+
+def set_session_warm(client: Client, dc_id: int, warm: bool) -> None:
+    """
+    Records whether the client has an open media session for the DC.
+    """
+    dcs = warm_dcs.setdefault(client.name, set())
+    if warm:
+        dcs.add(dc_id)
+    else:
+        dcs.discard(dc_id)
+
+
+def has_dc_session(name: str, dc_id: Optional[int]) -> bool:
+    return (
+        dc_id is None
+        or home_dcs.get(name) == dc_id
+        or dc_id in warm_dcs.get(name, ())
+    )
+
+
+def get_load_score(index: int, loads: dict, dc_id: int = None) -> float:
+    # Expected wait of a new operation, the work queued on the client times its latency
+    operations = loads[index] + bytes_in_flight.get(index, 0) / BYTES_PER_OPERATION
+    latency = client_latency.get(str(index), DEFAULT_LATENCY)
+    score = (operations + 1) * latency
+
+    # A client without a session for the DC of the file first has to open one
+    if not has_dc_session(str(index), dc_id):
+        score += COLD_SESSION_ROUND_TRIPS * latency
+    return score
+
+
+def rank_clients(clients: dict, loads: dict, dc_id: int = None) -> List[int]:
+    """
+    Returns the client indexes by expected wait, skipping draining clients and clients
+    taken out of rotation by their health. When every client is out, the one back
+    soonest comes first. Clients with a session for dc_id are preferred.
+    """
+    serving = [index for index in loads if index not in draining_clients] or list(loads)
+    available = [index for index in serving if get_health(clients[index]).available]
+    if not available:
+        return sorted(serving, key=lambda index: get_health(clients[index]).cooldown)
+    return sorted(available, key=lambda index: get_load_score(index, loads, dc_id))
+
+
+class ClientLease:
+    """
+    Clients handed out for one operation, their load is given back by release()
+    or when the lease is used as a context manager and the block exits.
+    """
+
+    def __init__(
+        self, clients: List[Client], indexes: List[int], loads: dict, size: int
+    ):
+        self.clients = clients
+        self.indexes = indexes
+        self.loads = loads
+        self.size = 0
+        self.released = False
+        self.add_bytes(size)
+
+    @property
+    def client(self) -> Client:
+        return self.clients[0]
+
+    def add_bytes(self, size: int) -> None:
+        """
+        Adds size bytes in flight on the leased clients, negative as bytes are sent.
+        """
+        size = max(size, -self.size)
+        self.size += size
+        for index in self.indexes:
+            # Clients removed while the lease was held are not tracked anymore
+            if index in self.loads:
+                bytes_in_flight[index] = bytes_in_flight.get(index, 0) + size
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.add_bytes(-self.size)
+        for index in self.indexes:
+            if index in self.loads:
+                self.loads[index] -= 1
+
+    def __enter__(self) -> "ClientLease":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def lease_clients(
+    count: int = 1, size: int = 0, premium_required: bool = False, dc_id: int = None
+) -> ClientLease:
+    """
+    Leases up to count distinct clients, the ones with the lowest expected wait first.
+    Pass the DC of the file to favour clients that do not need a new media session.
+    """
+    global multi_clients, work_loads, premium_clients, premium_work_loads
+
+    if premium_required:
+        clients, loads = premium_clients, premium_work_loads
+    else:
+        clients, loads = multi_clients, work_loads
+
+    indexes = rank_clients(clients, loads, dc_id)[: max(1, count)]
+    for index in indexes:
+        loads[index] += 1
+    return ClientLease([clients[index] for index in indexes], indexes, loads, size)
+
+
+def lease_client(
+    premium_required: bool = False, size: int = 0, dc_id: int = None
+) -> ClientLease:
+    return lease_clients(1, size, premium_required, dc_id)
+
 
 def get_client(premium_required=False) -> Client:
+    """
+    Returns the least loaded client for a single request, without counting it as load.
+    Operations that keep a client busy should use lease_client() instead.
+    """
     global multi_clients, work_loads, premium_clients, premium_work_loads
 
     if premium_required:
-        index = min(premium_work_loads, key=premium_work_loads.get)
-        premium_work_loads[index] += 1
+        index = rank_clients(premium_clients, premium_work_loads)[0]
         return premium_clients[index]
 
-    index = min(work_loads, key=work_loads.get)
-    work_loads[index] += 1
+    index = rank_clients(multi_clients, work_loads)[0]
     return multi_clients[index]
+
+
+def get_clients_health() -> List[dict]:
+    """
+    Returns the load, latency and health of every client.
+    """
+    stats = []
+    for clients, loads, type in (
+        (multi_clients, work_loads, "bot"),
+        (premium_clients, premium_work_loads, "user"),
+    ):
+        for index, client in clients.items():
+            stats.append(
+                {
+                    "client": client.name,
+                    "type": type,
+                    "work_load": loads.get(index, 0),
+                    "draining": index in draining_clients,
+                    "bytes_in_flight": bytes_in_flight.get(index, 0),
+                    "latency": round(client_latency.get(client.name, 0), 3),
+                    "home_dc": home_dcs.get(client.name),
+                    "warm_dcs": sorted(warm_dcs.get(client.name, ())),
+                    **get_health(client).stats(),
+                }
+            )
+    return stats
+
+
+# Bot tokens look like "123456:ABC-DEF...", anything else is a premium session string
+BOT_TOKEN_PATTERN = re.compile(r"^\d+:[\w-]+$")
+
+
+def get_token_type(token: str) -> str:
+    return "bot" if BOT_TOKEN_PATTERN.match(token) else "user"
+
+
+def find_client(token: str) -> Optional[int]:
+    for client_id, client_token in client_tokens.items():
+        if client_token == token:
+            return client_id
+    return None
+
+
+async def add_client(token: str) -> int:
+    """
+    Starts a client from a bot token or premium session string while running and
+    returns its index. A token that is already running returns the running client.
+    """
+    global last_client_id
+
+    token = token.strip()
+    client_id = find_client(token)
+    if client_id is not None:
+        return client_id
+
+    # The index is taken before starting, so concurrent additions never share one
+    last_client_id += 1
+    client_id = last_client_id
+    type = get_token_type(token)
+    if not await start_client(client_id, token, type):
+        raise Exception(f"Failed to start {type} client {client_id}")
+    return client_id
+
+
+def drain_client(client_id: int) -> None:
+    """
+    Takes a client out of rotation, it gets no new work while its leases finish.
+    """
+    if client_id in multi_clients:
+        serving = [index for index in multi_clients if index not in draining_clients]
+        if serving == [client_id]:
+            raise Exception("Can not remove the last bot client")
+        loads = work_loads
+    elif client_id in premium_clients:
+        loads = premium_work_loads
+    else:
+        raise Exception(f"Client {client_id} not found")
+
+    if client_id in draining_clients:
+        raise Exception(f"Client {client_id} is already being removed")
+
+    draining_clients.add(client_id)
+    logger.info(
+        f"Draining Client {client_id}, {loads[client_id]} operations in flight"
+    )
+
+
+async def stop_drained_client(client_id: int, timeout: float = None) -> None:
+    """
+    Waits up to timeout seconds for the leases (streams, uploads) of a draining client
+    to finish, then stops it and forgets everything about it.
+    """
+    if timeout is None:
+        timeout = config.CLIENT_DRAIN_TIMEOUT
+
+    if client_id in multi_clients:
+        clients, loads = multi_clients, work_loads
+    else:
+        clients, loads = premium_clients, premium_work_loads
+
+    deadline = time.monotonic() + timeout
+    while loads[client_id] > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+
+    if loads[client_id] > 0:
+        logger.warning(
+            f"Stopping Client {client_id} with {loads[client_id]} operations in flight"
+        )
+
+    client = clients.pop(client_id)
+    loads.pop(client_id)
+    client_tokens.pop(client_id, None)
+    bytes_in_flight.pop(client_id, None)
+    draining_clients.discard(client_id)
+
+    await forget_client(client)
+    try:
+        await client.stop()
+    except Exception as e:
+        logger.warning(f"Error stopping Client {client_id}: {e}")
+    logger.info(f"Removed Client {client_id}")
+
+
+async def remove_client(client_id: int, timeout: float = None) -> None:
+    """
+    Drains a client and stops it once its in flight operations are done.
+    """
+    drain_client(client_id)
+    await stop_drained_client(client_id, timeout)
+
+
+async def forget_client(client: Client) -> None:
+    """
+    Drops the per client state kept by the streamer, its media sessions included.
+    """
+    from utils.client_health import CLIENT_HEALTH
+    from utils.streamer import class_cache
+    from utils.streamer.scheduler import STREAM_SCHEDULER
+    from utils.streamer.session_pool import SESSION_POOLS
+
+    for key in [key for key in SESSION_POOLS if key[0] is client]:
+        pool = SESSION_POOLS.pop(key)
+        client.media_sessions.pop(pool.dc_id, None)
+        for pooled in list(pool.sessions):
+            pool.sessions.remove(pooled)
+            await pool.stop_session(pooled.session)
+
+    class_cache.pop(client, None)
+    STREAM_SCHEDULER.queues.pop(client, None)
+    CLIENT_HEALTH.pop(client.name, None)
+    client_latency.pop(client.name, None)
+    home_dcs.pop(client.name, None)
+    warm_dcs.pop(client.name, None)
+
+
+def read_clients_file(path: Path) -> List[str]:
+    """
+    Returns the bot tokens and session strings of the clients file, one per line.
+    Blank lines and lines starting with # are skipped.
+    """
+    tokens = []
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            tokens.append(line)
+    return tokens
+
+
+async def watch_clients_file() -> None:
+    """
+    Keeps the running clients in sync with CLIENTS_FILE. Clients added to the file are
+    started, clients removed from it are drained and stopped. Clients configured with
+    BOT_TOKENS or STRING_SESSIONS are never removed by the file.
+    """
+    if not config.CLIENTS_FILE:
+        return
+
+    path = Path(config.CLIENTS_FILE)
+    file_clients = {}  # token -> index of the clients started from the file
+    last_mtime = None
+
+    while True:
+        try:
+            mtime = path.stat().st_mtime if path.exists() else 0
+            if mtime != last_mtime:
+                last_mtime = mtime
+                tokens = read_clients_file(path) if mtime else []
+
+                for token in tokens:
+                    if token in file_clients or find_client(token) is not None:
+                        continue
+                    try:
+                        file_clients[token] = await add_client(token)
+                    except Exception as e:
+                        logger.error(f"Failed to add client from {path}: {e}")
+
+                for token in [token for token in file_clients if token not in tokens]:
+                    client_id = file_clients.pop(token)
+                    asyncio.create_task(remove_listed_client(client_id))
+        except Exception as e:
+            logger.error(f"Error reading clients file {path}: {e}")
+
+        await asyncio.sleep(config.CLIENTS_FILE_INTERVAL)
+
+
+async def remove_listed_client(client_id: int) -> None:
+    try:
+        await remove_client(client_id)
+    except Exception as e:
+        logger.error(f"Failed to remove Client {client_id}: {e}")
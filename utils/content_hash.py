@@ -0,0 +1,70 @@
+import config, hashlib
+from typing import List, Optional
+from pyrogram.types import Message
+from utils.logger import Logger
+from utils.streamer.file_properties import get_media_from_message
+
+logger = Logger(__name__)
+
+# Staged files are hashed in blocks of this size
+HASH_READ_SIZE = 1024 * 1024
+
+
+def get_sha256_key(hasher) -> str:
+    return f"sha256:{hasher.hexdigest()}"
+
+
+def hash_file(file_path) -> str:
+    """
+    Returns the hash key of a file on disk, blocking, run it in a thread.
+    """
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(HASH_READ_SIZE):
+            hasher.update(block)
+    return get_sha256_key(hasher)
+
+
+def get_unique_id_key(message: Message) -> Optional[str]:
+    """
+    Returns the hash key of the Telegram file of a message. Telegram gives every stored
+    file a unique id, so files the bot receives again match without downloading them.
+    """
+    media = get_media_from_message(message)
+    unique_id = getattr(media, "file_unique_id", None)
+    return f"tg:{unique_id}" if unique_id else None
+
+
+async def find_duplicate(hashes: List[str]) -> Optional[Message]:
+    """
+    Returns the storage channel message of a file already uploaded with one of the hashes,
+    or None. Entries of messages deleted from the channel are dropped.
+    """
+    from utils.client_health import get_health
+    from utils.clients import get_client
+    from utils.directoryHandler import DRIVE_DATA
+
+    hashes = [hash for hash in hashes if hash]
+    if not config.DEDUPLICATE_UPLOADS or not hashes:
+        return None
+
+    message_id = DRIVE_DATA.find_hash(hashes)
+    if message_id is None:
+        return None
+
+    client = get_client()
+    health = get_health(client)
+    await health.pace("message")
+    try:
+        message = await client.get_messages(config.STORAGE_CHANNEL, message_id)
+        health.record_success()
+    except Exception as e:
+        health.record_error(e)
+        logger.warning(f"Failed to fetch duplicate message {message_id}: {e!r}")
+        return None
+
+    if message.empty or not get_media_from_message(message):
+        logger.info(f"Message {message_id} of a stored hash no longer exists")
+        DRIVE_DATA.remove_hashes(message_id)
+        return None
+    return message
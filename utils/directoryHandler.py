@@ -1,6 +1,7 @@
 from pathlib import Path
 import sys
-import config, dill
+import config
+from pyrogram.errors import FloodWait
 from pyrogram.types import InputMediaDocument, Message
 import os, random, string, asyncio
 from utils.logger import Logger
@@ -53,6 +54,10 @@ class File:
         file_id: int,
         size: int,
         path: str,
+        tg_file_id: str = None,
+        dc_id: int = None,
+        mime_type: str = None,
+        thumbs: list = None,
     ) -> None:
         self.name = name
         self.file_id = file_id
@@ -63,6 +68,14 @@ class File:
         self.path = path[:-1] if path[-1] == "/" else path
         self.upload_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+        # Telegram file properties, lets /file stream without fetching the message first
+        self.tg_file_id = tg_file_id
+        self.dc_id = dc_id
+        self.mime_type = mime_type
+
+        # [size type, width, height] of the Telegram thumbnails, None until known
+        self.thumbs = thumbs
+
 
 class NewDriveData:
     def __init__(self, contents: dict, used_ids: list) -> None:
@@ -70,7 +83,12 @@ class NewDriveData:
         self.used_ids = used_ids
         self.isUpdated = False
 
+        # Storage channel message of every content hash, lets identical files share a message
+        self.hash_index = {}
+
     def save(self) -> None:
+        import dill
+
         with open(drive_cache_path, "wb") as f:
             dill.dump(self, f)
         self.isUpdated = True
@@ -93,10 +111,25 @@ class NewDriveData:
         self.save()
         return folder.path + folder.id
 
-    def new_file(self, path: str, name: str, file_id: int, size: int) -> None:
+    def new_file(
+        self,
+        path: str,
+        name: str,
+        file_id: int,
+        size: int,
+        tg_file_id: str = None,
+        dc_id: int = None,
+        mime_type: str = None,
+        thumbs: list = None,
+        hashes: list = None,
+    ) -> None:
         logger.info(f"Creating new file '{name}' in path '{path}'.")
 
-        file = File(name, file_id, size, path)
+        for hash in hashes or []:
+            if hash:
+                self.hash_index[hash] = file_id
+
+        file = File(name, file_id, size, path, tg_file_id, dc_id, mime_type, thumbs)
         if path == "/":
             directory_folder: Folder = self.contents[path]
             directory_folder.contents[file.id] = file
@@ -109,6 +142,45 @@ class NewDriveData:
 
         self.save()
 
+    def find_hash(self, hashes: list):
+        """Return the message of the first of the hashes stored, or None"""
+        for hash in hashes:
+            if hash in self.hash_index:
+                return self.hash_index[hash]
+        return None
+
+    def remove_hashes(self, file_id: int) -> None:
+        """Forget the hashes of a message deleted from the storage channel"""
+        for hash, message_id in list(self.hash_index.items()):
+            if message_id == file_id:
+                del self.hash_index[hash]
+        self.save()
+
+    def set_file_properties(
+        self,
+        file_id: int,
+        tg_file_id: str,
+        dc_id: int,
+        mime_type: str,
+        thumbs: list = None,
+    ) -> None:
+        """Store refreshed Telegram file properties on every file pointing at the message"""
+        root_dir = self.get_directory("/")
+
+        def traverse_directory(folder):
+            for item in folder.contents.values():
+                if item.type == "folder":
+                    traverse_directory(item)
+                elif item.file_id == file_id:
+                    item.tg_file_id = tg_file_id
+                    item.dc_id = dc_id
+                    item.mime_type = mime_type
+                    item.thumbs = thumbs
+
+        traverse_directory(root_dir)
+        self.save()
+        logger.info(f"Telegram file properties updated for message '{file_id}'.")
+
     def get_directory(
         self, path: str, is_admin: bool = True, auth: str = None
     ) -> Folder:
@@ -352,6 +424,21 @@ class NewDriveData:
         root_folder = self.get_directory("/")
         return build_tree(root_folder, "/")
 
+    def get_dc_ids(self) -> set:
+        """Return the Telegram DCs the drive files are stored on"""
+        root_dir = self.get_directory("/")
+        dc_ids = set()
+
+        def traverse_directory(folder):
+            for item in folder.contents.values():
+                if item.type == "folder":
+                    traverse_directory(item)
+                elif getattr(item, "dc_id", None):
+                    dc_ids.add(item.dc_id)
+
+        traverse_directory(root_dir)
+        return dc_ids
+
     def search_file_folder(self, query: str):
         logger.info(f"Searching for items matching query '{query}'.")
 
@@ -403,9 +490,9 @@ async def backup_drive_data(loop=True):
                 continue
 
             logger.info("Backing up drive data to Telegram.")
-            from utils.clients import get_client
+            from utils.client_health import get_health
+            from utils.clients import lease_client
 
-            client = get_client()
             time_text = f"📅 **Last Updated :** {get_current_utc_time()} (UTC +00:00)"
             caption = (
                 f"🔐 **TG Drive Data Backup File**\n\n"
@@ -414,12 +501,21 @@ async def backup_drive_data(loop=True):
             )
 
             media_doc = InputMediaDocument(drive_cache_path, caption=caption)
-            msg = await client.edit_message_media(
-                config.STORAGE_CHANNEL,
-                config.DATABASE_BACKUP_MSG_ID,
-                media=media_doc,
-                file_name="drive.data",
-            )
+            with lease_client(size=os.path.getsize(drive_cache_path)) as lease:
+                health = get_health(lease.client)
+                await health.pace("message")
+                try:
+                    msg = await lease.client.edit_message_media(
+                        config.STORAGE_CHANNEL,
+                        config.DATABASE_BACKUP_MSG_ID,
+                        media=media_doc,
+                        file_name="drive.data",
+                    )
+                    health.record_success()
+                except FloodWait as e:
+                    # The next attempt goes to another client
+                    health.record_error(e)
+                    raise
 
             DRIVE_DATA.isUpdated = False
             logger.info("Drive data backed up to Telegram successfully.")
@@ -446,6 +542,10 @@ async def init_drive_data():
     if not hasattr(root_dir, "auth_hashes"):
         root_dir.auth_hashes = []
 
+    # Drive data saved before content hashes were indexed
+    if not hasattr(DRIVE_DATA, "hash_index"):
+        DRIVE_DATA.hash_index = {}
+
     def traverse_directory(folder):
         for item in folder.contents.values():
             if item.type == "folder":
@@ -453,6 +553,11 @@ async def init_drive_data():
 
                 if not hasattr(item, "auth_hashes"):
                     item.auth_hashes = []
+            else:
+                # Files created before the Telegram file properties were stored
+                for attr in ("tg_file_id", "dc_id", "mime_type", "thumbs"):
+                    if not hasattr(item, attr):
+                        setattr(item, attr, None)
 
     traverse_directory(root_dir)
     DRIVE_DATA.save()
@@ -484,6 +589,8 @@ async def loadDriveData():
             os.kill(os.getpid(), signal.SIGKILL)
 
         if msg.document.file_name == "drive.data":
+            import dill
+
             dl_path = await msg.download()
             with open(dl_path, "rb") as f:
                 DRIVE_DATA = dill.load(f)
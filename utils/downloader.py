@@ -3,8 +3,7 @@ import aiohttp, asyncio
 from utils.extra import get_filename
 from utils.logger import Logger
 from pathlib import Path
-from utils.uploader import start_file_uploader
-from techzdl import TechZDL
+from utils.job_queue import submit_upload
 
 logger = Logger(__name__)
 
@@ -25,11 +24,14 @@ async def download_progress_callback(status, current, total, id):
     )
 
 
-async def download_file(url, id, path, filename, singleThreaded):
+async def download_file(url, id, path, filename, singleThreaded, priority=0):
     global DOWNLOAD_PROGRESS, STOP_DOWNLOAD
 
     logger.info(f"Downloading file from {url}")
 
+    # Imported on first use, techzdl pulls in curl_cffi and slows down startup
+    from techzdl import TechZDL
+
     try:
         downloader = TechZDL(
             url,
@@ -62,17 +64,23 @@ async def download_file(url, id, path, filename, singleThreaded):
 
         logger.info(f"File downloaded to {downloader.output_path}")
 
-        asyncio.create_task(
-            start_file_uploader(
-                downloader.output_path, id, path, filename, downloader.total_size
-            )
+        submit_upload(
+            downloader.output_path,
+            id,
+            path,
+            filename,
+            downloader.total_size,
+            priority=priority,
         )
     except Exception as e:
-        DOWNLOAD_PROGRESS[id] = ("error", 0, 0)
         logger.error(f"Failed to download file: {url} {e}")
+        # The job queue retries the download and reports the error once it gives up
+        raise
 
 
 async def get_file_info_from_url(url):
+    from techzdl import TechZDL
+
     downloader = TechZDL(
         url,
         output_dir=cache_dir,
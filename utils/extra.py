@@ -36,6 +36,8 @@ def convert_class_to_dict(data, isObject, showtrash=False, sort_by="date", sort_
                     "id": file.id,
                     "path": file.path,
                     "upload_date": file.upload_date,
+                    # None when the thumbnails of the file are not known yet
+                    "thumb": bool(file.thumbs) if file.thumbs is not None else None,
                 }
     
     # Sort the contents
@@ -98,9 +100,24 @@ import shutil
 
 
 def reset_cache_dir():
+    # Only the temporary directories are reset, CHUNK_CACHE_DIR and SESSION_DIR are kept
+    from utils.chunked_upload import get_upload_files
+    from utils.job_queue import get_staged_files
+
     cache_dir = Path("./cache")
     downloads_dir = Path("./downloads")
-    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    # Files staged for pending upload jobs are kept, the jobs resume after the restart,
+    # and so are unfinished chunked uploads, the website can resume them
+    staged_files = get_staged_files() | get_upload_files()
+    if cache_dir.exists():
+        for item in cache_dir.iterdir():
+            if item.resolve() in staged_files:
+                continue
+            if item.is_dir():
+                shutil.rmtree(item, ignore_errors=True)
+            else:
+                item.unlink(missing_ok=True)
     shutil.rmtree(downloads_dir, ignore_errors=True)
     cache_dir.mkdir(parents=True, exist_ok=True)
     downloads_dir.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,376 @@
+import asyncio, config, json, os, time
+from pathlib import Path
+from typing import Dict, List, Set
+from utils.directoryHandler import getRandomID
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Job kinds, uploads of staged files to Telegram and imports of files from URLs
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+# Job states, finished jobs are kept in memory only
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELED = "canceled"
+PENDING_STATES = (QUEUED, RUNNING)
+
+# Seconds before a failed job is tried again, doubled for every further attempt
+RETRY_DELAY = 30
+
+# Finished jobs listed by /api/getJobs, older ones are forgotten
+FINISHED_JOBS_KEPT = 100
+
+
+class Job:
+    """
+    A transfer waiting for or holding a slot of the job queue. transfer_id is the id the
+    website tracks the progress of the transfer with.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        transfer_id: str,
+        params: dict,
+        priority: int = 0,
+        id: str = None,
+        state: str = QUEUED,
+        attempts: int = 0,
+        error: str = None,
+        created: float = None,
+    ):
+        self.id = id or getRandomID()
+        self.kind = kind
+        self.transfer_id = transfer_id
+        self.params = params
+        self.priority = priority
+        self.state = state
+        self.attempts = attempts
+        self.error = error
+        self.created = created or time.time()
+        self.retry_at = 0.0
+        self.cancel_requested = False
+        self.finished = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "transfer_id": self.transfer_id,
+            "params": self.params,
+            "priority": self.priority,
+            "state": self.state,
+            "attempts": self.attempts,
+            "error": self.error,
+            "created": self.created,
+        }
+
+
+def load_job_files(jobs_dir: Path) -> List[Job]:
+    jobs = []
+    for path in sorted(jobs_dir.glob("*.json")):
+        try:
+            jobs.append(Job(**json.loads(path.read_text())))
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Skipping unreadable job file {path}: {e}")
+    return jobs
+
+
+def get_staged_files() -> Set[Path]:
+    """
+    Returns the files in ./cache that pending upload jobs still have to send, so the
+    cache reset on startup keeps them.
+    """
+    jobs_dir = Path(config.JOBS_DIR)
+    if not jobs_dir.exists():
+        return set()
+    return {
+        Path(job.params["file_path"]).resolve()
+        for job in load_job_files(jobs_dir)
+        if job.kind == UPLOAD and job.state in PENDING_STATES
+    }
+
+
+class JobQueue:
+    """
+    Runs uploads and URL imports by priority (highest first, then oldest) with at most
+    JOB_CONCURRENCY of them at once. Failed jobs are retried with a growing delay up to
+    JOB_ATTEMPTS times. Pending jobs are written to JOBS_DIR and resumed after a restart.
+    """
+
+    def __init__(self, jobs_dir: Path, concurrency: int, attempts: int):
+        self.jobs_dir = jobs_dir
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.jobs: Dict[str, Job] = {}
+        self.running: Dict[str, asyncio.Task] = {}
+        self.wakeup = asyncio.Event()
+        self.dispatcher: asyncio.Task = None
+
+    def start(self) -> None:
+        """
+        Loads the jobs left pending by the previous run and starts dispatching.
+        """
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        for job in load_job_files(self.jobs_dir):
+            if job.state not in PENDING_STATES:
+                self.delete_job_file(job)
+                continue
+            if job.kind == UPLOAD and not Path(job.params["file_path"]).exists():
+                job.state = FAILED
+                job.error = "Staged file is missing"
+                self.delete_job_file(job)
+            else:
+                job.state = QUEUED
+                self.save_job(job)
+            self.jobs[job.id] = job
+
+        resumed = sum(job.state == QUEUED for job in self.jobs.values())
+        if resumed:
+            logger.info(f"Resuming {resumed} transfer jobs")
+
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self.dispatch())
+
+    def submit(
+        self, kind: str, transfer_id: str, params: dict, priority: int = 0
+    ) -> Job:
+        job = Job(kind, transfer_id, params, priority)
+        self.jobs[job.id] = job
+        self.save_job(job)
+        self.wakeup.set()
+        logger.info(f"Queued {kind} job {job.id} for transfer {transfer_id}")
+        return job
+
+    def get_job_path(self, job: Job) -> Path:
+        return self.jobs_dir / f"{job.id}.json"
+
+    def save_job(self, job: Job) -> None:
+        path = self.get_job_path(job)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(job.to_dict()))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to store job {job.id}: {e}")
+
+    def delete_job_file(self, job: Job) -> None:
+        self.get_job_path(job).unlink(missing_ok=True)
+
+    def next_jobs(self) -> List[Job]:
+        now = time.monotonic()
+        queued = [
+            job
+            for job in self.jobs.values()
+            if job.state == QUEUED and job.retry_at <= now
+        ]
+        return sorted(queued, key=lambda job: (-job.priority, job.created))
+
+    async def dispatch(self) -> None:
+        while True:
+            self.wakeup.clear()
+            for job in self.next_jobs():
+                if len(self.running) >= self.concurrency:
+                    break
+                job.state = RUNNING
+                self.save_job(job)
+                self.running[job.id] = asyncio.create_task(self.execute(job))
+
+            # Sleep until a job is added or finishes, or the next retry is due
+            retries = [
+                job.retry_at
+                for job in self.jobs.values()
+                if job.state == QUEUED and job.retry_at > 0
+            ]
+            timeout = max(min(retries) - time.monotonic(), 0.1) if retries else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def execute(self, job: Job) -> None:
+        from utils.downloader import DOWNLOAD_PROGRESS, STOP_DOWNLOAD
+        from utils.uploader import PROGRESS_CACHE, STOP_TRANSMISSION
+
+        job.attempts += 1
+        try:
+            await run_job(job)
+            if (
+                job.cancel_requested
+                or job.transfer_id in STOP_TRANSMISSION
+                or job.transfer_id in STOP_DOWNLOAD
+            ):
+                job.state = CANCELED
+            else:
+                job.state = COMPLETED
+            job.error = None
+        except Exception as e:
+            job.error = repr(e)
+            if job.cancel_requested:
+                job.state = CANCELED
+            elif job.attempts < self.attempts:
+                delay = RETRY_DELAY * 2 ** (job.attempts - 1)
+                logger.warning(
+                    f"Job {job.id} failed (attempt {job.attempts}), retrying in {delay}s: {e!r}"
+                )
+                job.state = QUEUED
+                job.retry_at = time.monotonic() + delay
+                if job.kind == DOWNLOAD:
+                    DOWNLOAD_PROGRESS[job.transfer_id] = ("Retrying", 0, 1)
+            else:
+                logger.error(f"Job {job.id} failed after {job.attempts} attempts: {e!r}")
+                job.state = FAILED
+                if job.kind == DOWNLOAD:
+                    DOWNLOAD_PROGRESS[job.transfer_id] = ("error", 0, 0)
+                else:
+                    PROGRESS_CACHE[job.transfer_id] = ("error", 0, 0)
+        finally:
+            self.running.pop(job.id, None)
+            if job.state in PENDING_STATES:
+                self.save_job(job)
+            else:
+                self.finish(job)
+            self.wakeup.set()
+
+    def finish(self, job: Job) -> None:
+        """
+        Deletes the file of a job that ended, only the last FINISHED_JOBS_KEPT stay listed.
+        """
+        job.finished = time.time()
+        self.delete_job_file(job)
+
+        finished = [j for j in self.jobs.values() if j.state not in PENDING_STATES]
+        if len(finished) > FINISHED_JOBS_KEPT:
+            finished.sort(key=lambda j: j.finished)
+            for old_job in finished[: len(finished) - FINISHED_JOBS_KEPT]:
+                del self.jobs[old_job.id]
+
+    def get_job(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise Exception(f"Job {job_id} not found")
+        return job
+
+    def set_priority(self, job_id: str, priority: int) -> None:
+        job = self.get_job(job_id)
+        job.priority = priority
+        if job.state in PENDING_STATES:
+            self.save_job(job)
+        self.wakeup.set()
+
+    def cancel(self, job_id: str) -> None:
+        """
+        Cancels a queued job, a running one is stopped like a transfer canceled by the website.
+        """
+        from utils.downloader import STOP_DOWNLOAD
+        from utils.uploader import STOP_TRANSMISSION
+
+        job = self.get_job(job_id)
+        if job.state not in PENDING_STATES:
+            raise Exception(f"Job {job_id} is already {job.state}")
+
+        job.cancel_requested = True
+        if job.state == RUNNING:
+            STOP_TRANSMISSION.append(job.transfer_id)
+            STOP_DOWNLOAD.append(job.transfer_id)
+            return
+
+        job.state = CANCELED
+        self.finish(job)
+        if job.kind == UPLOAD:
+            Path(job.params["file_path"]).unlink(missing_ok=True)
+
+    def cancel_transfer(self, transfer_id: str) -> None:
+        for job in list(self.jobs.values()):
+            if job.transfer_id == transfer_id and job.state == QUEUED:
+                self.cancel(job.id)
+
+    def list_jobs(self) -> List[dict]:
+        jobs = sorted(
+            self.jobs.values(),
+            key=lambda job: (job.state not in PENDING_STATES, -job.priority, job.created),
+        )
+        return [
+            {**job.to_dict(), "running": job.id in self.running} for job in jobs
+        ]
+
+
+async def run_job(job: Job) -> None:
+    from utils.downloader import download_file
+    from utils.uploader import start_file_uploader
+
+    params = job.params
+    if job.kind == UPLOAD:
+        await start_file_uploader(
+            params["file_path"],
+            job.transfer_id,
+            params["directory_path"],
+            params["filename"],
+            params["file_size"],
+            content_hash=params.get("content_hash"),
+        )
+    elif job.kind == DOWNLOAD:
+        await download_file(
+            params["url"],
+            job.transfer_id,
+            params["path"],
+            params["filename"],
+            params["singleThreaded"],
+            priority=job.priority,
+        )
+    else:
+        raise ValueError(f"Unknown job kind {job.kind}")
+
+
+JOB_QUEUE = JobQueue(Path(config.JOBS_DIR), config.JOB_CONCURRENCY, config.JOB_ATTEMPTS)
+
+
+def submit_upload(
+    file_path,
+    id,
+    directory_path,
+    filename,
+    file_size,
+    priority: int = 0,
+    content_hash: str = None,
+) -> Job:
+    from utils.uploader import PROGRESS_CACHE
+
+    # The website polls the progress right away, queued uploads show as not started
+    PROGRESS_CACHE[id] = ("running", 0, file_size)
+    return JOB_QUEUE.submit(
+        UPLOAD,
+        id,
+        {
+            "file_path": str(file_path),
+            "directory_path": directory_path,
+            "filename": filename,
+            "file_size": file_size,
+            "content_hash": content_hash,
+        },
+        priority,
+    )
+
+
+def submit_download(
+    url, id, path, filename, singleThreaded, priority: int = 0
+) -> Job:
+    from utils.downloader import DOWNLOAD_PROGRESS
+
+    DOWNLOAD_PROGRESS[id] = ("Queued", 0, 1)
+    return JOB_QUEUE.submit(
+        DOWNLOAD,
+        id,
+        {
+            "url": url,
+            "path": path,
+            "filename": filename,
+            "singleThreaded": singleThreaded,
+        },
+        priority,
+    )
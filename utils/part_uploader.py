@@ -0,0 +1,209 @@
+import asyncio, config, math
+from hashlib import md5
+from typing import List
+from pyrogram import Client, raw
+from pyrogram.errors import FloodWait, InternalServerError
+from pyrogram.session import Session
+from utils.client_health import get_health
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Files are uploaded in parts of the largest size Telegram accepts
+UPLOAD_PART_SIZE = 512 * 1024
+
+# Files larger than this are uploaded with SaveBigFilePart, like pyrogram does
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+# Parts in flight on every upload session at most, and when an upload starts
+SESSION_MAX_PARTS = 4
+INITIAL_WINDOW = 4
+
+# Times a part is sent before the upload fails
+PART_ATTEMPTS = 5
+
+
+class PartUploader:
+    """
+    Uploads the parts of one file over several upload sessions of a client and returns
+    the InputFile to send. Parts saved by one account can only be sent by that account,
+    so a file is never spread over several clients.
+
+    The number of parts in flight adapts like a congestion window: it grows by one after
+    a window of saved parts and halves on a flood wait or error. Failed parts are sent
+    again, flood waits are slept unless restartable is set and the wait is longer than
+    SLEEP_THRESHOLD, the caller can then restart the file on another client.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        file_name: str,
+        file_size: int,
+        on_progress=None,
+        max_window: int = None,
+        restartable: bool = False,
+    ):
+        self.client = client
+        self.file_name = file_name
+        self.file_size = file_size
+        self.on_progress = on_progress
+        self.restartable = restartable
+
+        self.is_big = file_size > BIG_FILE_SIZE
+        self.total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        self.file_id = client.rnd_id()
+        self.md5_sum = None if self.is_big else md5()
+
+        sessions_count = config.UPLOAD_SESSIONS if self.is_big else 1
+        self.max_window = sessions_count * SESSION_MAX_PARTS
+        if max_window:
+            self.max_window = max(1, min(self.max_window, max_window))
+        self.window = min(INITIAL_WINDOW, self.max_window)
+        self.saved_in_window = 0
+
+        self.sessions: List[Session] = []
+        self.sessions_count = sessions_count
+        self.session_loads = {}
+        self.tasks = set()
+        self.in_flight = 0
+        self.uploaded = 0
+        self.error: Exception = None
+        self.changed = asyncio.Condition()
+
+    async def start(self) -> None:
+        client = self.client
+        for _ in range(self.sessions_count):
+            session = Session(
+                client,
+                await client.storage.dc_id(),
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await session.start()
+            self.sessions.append(session)
+            self.session_loads[session] = 0
+
+    async def put(self, file_part: int, data: bytes) -> None:
+        """
+        Starts sending a part, waits while the window is full.
+        Parts must be put in order for the md5 of small files.
+        """
+        if self.md5_sum:
+            self.md5_sum.update(data)
+
+        async with self.changed:
+            await self.changed.wait_for(
+                lambda: self.error or self.in_flight < self.window
+            )
+            if self.error:
+                raise self.error
+            self.in_flight += 1
+
+        task = asyncio.create_task(self.send(file_part, data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, file_part: int, data: bytes) -> None:
+        if self.is_big:
+            rpc = raw.functions.upload.SaveBigFilePart(
+                file_id=self.file_id,
+                file_part=file_part,
+                file_total_parts=self.total_parts,
+                bytes=data,
+            )
+        else:
+            rpc = raw.functions.upload.SaveFilePart(
+                file_id=self.file_id, file_part=file_part, bytes=data
+            )
+
+        try:
+            await self.save_part(rpc)
+            self.uploaded += len(data)
+            if self.on_progress:
+                self.on_progress(self.uploaded, self.file_size)
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            async with self.changed:
+                self.in_flight -= 1
+                self.changed.notify_all()
+
+    async def save_part(self, rpc) -> None:
+        health = get_health(self.client)
+        error = None
+        for attempt in range(1, PART_ATTEMPTS + 1):
+            session = min(self.sessions, key=lambda s: self.session_loads[s])
+            self.session_loads[session] += 1
+            try:
+                saved = await session.invoke(rpc, sleep_threshold=0)
+            except FloodWait as e:
+                health.record_error(e)
+                self.shrink_window()
+                if self.restartable and e.value > config.SLEEP_THRESHOLD:
+                    raise
+                logger.warning(
+                    f"Flood wait of {e.value}s uploading part {rpc.file_part}, "
+                    f"window {self.window}"
+                )
+                error = e
+                await asyncio.sleep(e.value)
+                continue
+            except (InternalServerError, OSError, TimeoutError) as e:
+                health.record_error(e)
+                self.shrink_window()
+                error = e
+            else:
+                if saved:
+                    health.record_success()
+                    self.grow_window()
+                    return
+                error = Exception(f"Telegram did not save part {rpc.file_part}")
+            finally:
+                self.session_loads[session] -= 1
+
+            if self.error:
+                raise self.error
+            await asyncio.sleep(attempt)
+        raise error
+
+    def grow_window(self) -> None:
+        self.saved_in_window += 1
+        if self.saved_in_window >= self.window and self.window < self.max_window:
+            self.window += 1
+            self.saved_in_window = 0
+
+    def shrink_window(self) -> None:
+        self.window = max(1, self.window // 2)
+        self.saved_in_window = 0
+
+    async def finish(self):
+        """
+        Waits for the parts in flight and returns the InputFile of the uploaded file.
+        """
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.in_flight == 0)
+        if self.error:
+            raise self.error
+
+        if self.is_big:
+            return raw.types.InputFileBig(
+                id=self.file_id, parts=self.total_parts, name=self.file_name
+            )
+        return raw.types.InputFile(
+            id=self.file_id,
+            parts=self.total_parts,
+            name=self.file_name,
+            md5_checksum=self.md5_sum.hexdigest(),
+        )
+
+    async def close(self) -> None:
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for session in self.sessions:
+            try:
+                await session.stop()
+            except Exception as e:
+                logger.debug(f"Error stopping upload session: {e}")
@@ -1,11 +1,26 @@
-import math, mimetypes
+import asyncio, mimetypes, secrets, config
+from datetime import datetime, timezone
 from fastapi.responses import StreamingResponse, Response
 from utils.logger import Logger
 from utils.streamer.custom_dl import ByteStreamer
+from utils.streamer.faststart import (
+    FASTSTART_MIME_TYPES,
+    FaststartLayout,
+    get_faststart_layout,
+)
 from utils.streamer.file_properties import get_name
-from utils.clients import (
-    get_client,
+from utils.streamer.scheduler import BULK, INTERACTIVE, STREAM_SCHEDULER, Flow
+from utils.streamer.http_range import (
+    RangeNotSatisfiable,
+    evaluate_preconditions,
+    format_http_date,
+    if_range_matches,
+    multipart_end,
+    multipart_length,
+    multipart_part_header,
+    parse_range_header,
 )
+from utils.clients import ClientLease, lease_clients
 from urllib.parse import quote
 
 logger = Logger(__name__)
@@ -13,52 +28,182 @@ logger = Logger(__name__)
 class_cache = {}
 
 
-async def media_streamer(channel: int, message_id: int, file_name: str, request):
+def get_streamer(client) -> ByteStreamer:
     global class_cache
 
-    range_header = request.headers.get("Range", 0)
-
-    faster_client = get_client()
+    if client in class_cache:
+        return class_cache[client]
 
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
-    else:
-        tg_connect = ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
+    tg_connect = ByteStreamer(client)
+    class_cache[client] = tg_connect
+    return tg_connect
 
-    file_id = await tg_connect.get_file_properties(channel, message_id)
-    file_size = file_id.file_size
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = 0
-        until_bytes = file_size - 1
-
-    if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
-        return Response(
-            status_code=416,
-            content="416: Range not satisfiable",
-            headers={"Content-Range": f"bytes */{file_size}"},
-        )
+async def get_stripes(clients: list, channel: int, file) -> list:
+    """
+    Returns the (ByteStreamer, FileId) pairs of the extra clients a stream is striped across.
+    """
+    streamers = [get_streamer(client) for client in clients]
+    file_ids = await asyncio.gather(
+        *(
+            streamer.get_file_properties(channel, file.file_id, file)
+            for streamer in streamers
+        ),
+        return_exceptions=True,
+    )
+    return [
+        (streamer, file_id)
+        for streamer, file_id in zip(streamers, file_ids)
+        if not isinstance(file_id, Exception)
+    ]
 
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
 
+def yield_range(
+    tg_connect: ByteStreamer,
+    file_id,
+    from_bytes: int,
+    until_bytes: int,
+    stripes: list,
+    chunk_size: int = 1024 * 1024,
+    flow: Flow = None,
+):
+    """
+    Returns the generator yielding the bytes from_bytes to until_bytes (inclusive) of the file.
+    """
     offset = from_bytes - (from_bytes % chunk_size)
     first_part_cut = from_bytes - offset
     last_part_cut = until_bytes % chunk_size + 1
+    part_count = until_bytes // chunk_size - offset // chunk_size + 1
 
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, offset, first_part_cut, last_part_cut, part_count, chunk_size
+    return tg_connect.yield_file(
+        file_id,
+        offset,
+        first_part_cut,
+        last_part_cut,
+        part_count,
+        chunk_size,
+        stripes,
+        flow,
     )
 
+
+async def read_bytes(
+    tg_connect: ByteStreamer, file_id, from_bytes: int, until_bytes: int
+) -> bytes:
+    body = yield_range(tg_connect, file_id, from_bytes, until_bytes, [])
+    return b"".join([chunk async for chunk in body])
+
+
+async def yield_faststart_range(
+    tg_connect: ByteStreamer,
+    file_id,
+    layout: FaststartLayout,
+    from_bytes: int,
+    until_bytes: int,
+    stripes: list,
+    flow: Flow = None,
+):
+    """
+    Yields the bytes from_bytes to until_bytes (inclusive) of the faststart layout of the file.
+    """
+    for piece in layout.split_range(from_bytes, until_bytes):
+        if piece[0] == "data":
+            yield piece[1]
+        else:
+            async for chunk in yield_range(
+                tg_connect, file_id, piece[1], piece[2], stripes, flow=flow
+            ):
+                yield chunk
+
+
+async def yield_multipart(
+    read_range,
+    ranges: list,
+    boundary: str,
+    content_type: str,
+    file_size: int,
+):
+    """
+    Yields a multipart/byteranges body with one part for each of the ranges.
+    """
+    for byte_range in ranges:
+        yield multipart_part_header(boundary, content_type, byte_range, file_size)
+        async for chunk in read_range(byte_range[0], byte_range[1]):
+            yield chunk
+    yield multipart_end(boundary)
+
+
+async def yield_stream(body, lease: ClientLease):
+    """
+    Yields the body of a stream, counting the sent bytes off the client lease.
+    """
+    async for chunk in body:
+        lease.add_bytes(-len(chunk))
+        yield chunk
+
+
+class LeasedStreamingResponse(StreamingResponse):
+    """
+    Streaming response that closes the scheduler flow and releases the clients when it
+    ends. The body generator may never start when the client is already gone, so this
+    can not be left to the generator.
+    """
+
+    def __init__(self, *args, lease: ClientLease, flow: Flow, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lease = lease
+        self.flow = flow
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            STREAM_SCHEDULER.close_flow(self.flow)
+            self.lease.release()
+
+
+def get_last_modified(file) -> datetime:
+    try:
+        upload_date = datetime.strptime(file.upload_date, "%Y-%m-%d %H:%M:%S")
+    except (AttributeError, ValueError):
+        upload_date = datetime(1970, 1, 1)
+    return upload_date.replace(tzinfo=timezone.utc)
+
+
+async def media_streamer(channel: int, file, request):
+    # The fastest client serves the stream, the others only help fetching its parts.
+    # The clients stay leased until the body is sent, or right away for other responses.
+    lease = lease_clients(
+        1 if request.method == "HEAD" else config.STREAM_STRIPE_CLIENTS,
+        dc_id=getattr(file, "dc_id", None),
+    )
+    try:
+        response = await serve_file(lease, channel, file, request)
+    except BaseException:
+        lease.release()
+        raise
+
+    if not isinstance(response, StreamingResponse):
+        lease.release()
+    return response
+
+
+async def serve_file(lease: ClientLease, channel: int, file, request):
+    file_name = file.name
+    is_head = request.method == "HEAD"
+
+    faster_client, *stripe_clients = lease.clients
+    tg_connect = get_streamer(faster_client)
+
+    file_id = await tg_connect.get_file_properties(channel, file.file_id, file)
+    file_size = file_id.file_size
+
     disposition = "attachment"
-    mime_type = mimetypes.guess_type(file_name.lower())[0] or "application/octet-stream"
+    mime_type = (
+        file_id.mime_type
+        or mimetypes.guess_type(file_name.lower())[0]
+        or "application/octet-stream"
+    )
 
     if (
         "video/" in mime_type
@@ -68,15 +213,96 @@ async def media_streamer(channel: int, message_id: int, file_name: str, request)
     ):
         disposition = "inline"
 
-    return StreamingResponse(
-        status_code=206 if range_header else 200,
+    # Serve MP4 files with the moov box relocated to the front, so playback starts after one read
+    faststart = (
+        request.query_params.get("faststart") == "1"
+        and mime_type in FASTSTART_MIME_TYPES
+    )
+
+    # Telegram files never change, the media id and size make a strong validator
+    etag = f'"{file_id.media_id:x}-{file_size:x}{"-faststart" if faststart else ""}"'
+    last_modified = get_last_modified(file)
+    headers = {
+        "Content-Type": f"{mime_type}",
+        "Content-Disposition": f'{disposition}; filename="{quote(file_name)}"',
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": format_http_date(last_modified),
+    }
+
+    status = evaluate_preconditions(request.headers, etag, last_modified)
+    if status is not None:
+        del headers["Content-Type"], headers["Content-Disposition"]
+        return Response(status_code=status, headers=headers)
+
+    ranges = None
+    if if_range_matches(request.headers, etag, last_modified):
+        try:
+            ranges = parse_range_header(request.headers.get("Range"), file_size)
+        except RangeNotSatisfiable:
+            return Response(
+                status_code=416,
+                content="416: Range not satisfiable",
+                headers={"Content-Range": f"bytes */{file_size}"},
+            )
+
+    if ranges is None:
+        ranges = [(0, file_size - 1)]
+        status = 200
+    else:
+        status = 206
+
+    if len(ranges) == 1:
+        from_bytes, until_bytes = ranges[0]
+        headers["Content-Length"] = str(until_bytes - from_bytes + 1)
+        if status == 206:
+            headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+    else:
+        boundary = secrets.token_hex(16)
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(
+            multipart_length(boundary, mime_type, ranges, file_size)
+        )
+
+    if is_head or file_size == 0:
+        return Response(status_code=status, headers=headers)
+
+    layout = None
+    if faststart:
+        layout = await get_faststart_layout(
+            file_id.media_id,
+            lambda start, end: read_bytes(tg_connect, file_id, start, end),
+            file_size,
+        )
+
+    stripes = await get_stripes(stripe_clients, channel, file)
+
+    # Playback ranges win GetFile slots over downloads, shared links share a bandwidth ceiling
+    flow = STREAM_SCHEDULER.open_flow(
+        file_name,
+        INTERACTIVE if disposition == "inline" else BULK,
+        shared="auth" in request.query_params,
+    )
+
+    def read_range(start: int, end: int):
+        if layout is not None:
+            return yield_faststart_range(
+                tg_connect, file_id, layout, start, end, stripes, flow
+            )
+        return yield_range(tg_connect, file_id, start, end, stripes, flow=flow)
+
+    if len(ranges) == 1:
+        body = read_range(from_bytes, until_bytes)
+    else:
+        body = yield_multipart(read_range, ranges, boundary, mime_type, file_size)
+    lease.add_bytes(int(headers["Content-Length"]))
+    body = yield_stream(body, lease)
+
+    return LeasedStreamingResponse(
+        status_code=status,
         content=body,
-        headers={
-            "Content-Type": f"{mime_type}",
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{quote(file_name)}"',
-            "Accept-Ranges": "bytes",
-        },
-        media_type=mime_type,
+        headers=headers,
+        media_type=headers["Content-Type"],
+        lease=lease,
+        flow=flow,
     )
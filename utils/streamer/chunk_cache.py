@@ -0,0 +1,123 @@
+import asyncio, config, os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+PartKey = Tuple[int, int, int]  # (media_id, offset, limit)
+
+
+class ChunkCache:
+    """
+    Disk backed cache of Telegram file parts, the least recently used parts are evicted once
+    the cached bytes exceed the byte budget. The index is rebuilt from the cache directory on
+    startup so cached parts survive restarts.
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int, name: str = "chunk"):
+        self.cache_dir = cache_dir
+        self.name = name
+        self.max_size = max_size
+        self.size = 0
+        self.entries: "OrderedDict[PartKey, int]" = OrderedDict()
+        self.writing = set()
+
+        if self.enabled:
+            self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get_path(self, key: PartKey) -> Path:
+        media_id, offset, limit = key
+        return self.cache_dir / f"{media_id}_{offset}_{limit}.part"
+
+    def load(self) -> None:
+        """
+        Builds the index from the parts on disk, oldest first, and removes unfinished writes.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        parts = []
+        for path in self.cache_dir.iterdir():
+            if path.suffix != ".part":
+                # Leftover temporary file of a write interrupted by a crash
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                media_id, offset, limit = map(int, path.stem.split("_"))
+                stat = path.stat()
+            except (ValueError, OSError):
+                path.unlink(missing_ok=True)
+                continue
+            parts.append((stat.st_mtime, (media_id, offset, limit), stat.st_size))
+
+        for _, key, size in sorted(parts):
+            self.entries[key] = size
+            self.size += size
+
+        self.evict()
+        logger.info(
+            f"Loaded {self.name} cache with {len(self.entries)} parts ({self.size} bytes)"
+        )
+
+    def evict(self) -> None:
+        while self.size > self.max_size and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.get_path(key).unlink(missing_ok=True)
+
+    def _read(self, path: Path) -> bytes:
+        with open(path, "rb") as f:
+            data = f.read()
+        # Refresh the modification time so the LRU order survives restarts
+        os.utime(path)
+        return data
+
+    def _write(self, path: Path, data: bytes) -> None:
+        # Write to a temporary file and atomically rename it, a crash never leaves a partial part
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    async def get(self, key: PartKey) -> Optional[bytes]:
+        if key not in self.entries:
+            return None
+
+        self.entries.move_to_end(key)
+        try:
+            return await asyncio.to_thread(self._read, self.get_path(key))
+        except OSError as e:
+            logger.warning(f"Dropping unreadable {self.name} cache entry {key}: {e}")
+            self.size -= self.entries.pop(key, 0)
+            return None
+
+    async def put(self, key: PartKey, data: bytes) -> None:
+        if (
+            not self.enabled
+            or not data
+            or len(data) > self.max_size
+            or key in self.entries
+            or key in self.writing
+        ):
+            return
+
+        self.writing.add(key)
+        try:
+            await asyncio.to_thread(self._write, self.get_path(key), data)
+            self.entries[key] = len(data)
+            self.size += len(data)
+            self.evict()
+        except OSError as e:
+            logger.warning(f"Failed to write {self.name} cache entry {key}: {e}")
+        finally:
+            self.writing.discard(key)
+
+
+CHUNK_CACHE = ChunkCache(Path(config.CHUNK_CACHE_DIR), config.CHUNK_CACHE_SIZE)
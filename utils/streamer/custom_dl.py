@@ -1,89 +1,107 @@
-import asyncio
-from typing import Dict, Union
+import asyncio, config
+from collections import deque
+from typing import List, Optional, Tuple, Union
 from pyrogram import Client, utils, raw
-from .file_properties import get_file_ids
-from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from .chunk_cache import CHUNK_CACHE, PartKey
+from .file_id_cache import FILE_ID_CACHE
+from .file_properties import get_file_ids, get_stored_file_ids
+from .part_cache import HOT_PARTS, PART_FLIGHTS
+from .scheduler import STREAM_SCHEDULER, Flow
+from .session_pool import MediaSessionPool, get_session_pool
+from pyrogram.errors import (
+    FileReferenceExpired,
+    FloodWait,
+    InternalServerError,
+    ServiceUnavailable,
+    Unauthorized,
+)
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
+from utils.client_health import get_health
 from utils.logger import Logger
 
 logger = Logger(__name__)
 
+# Errors a stream recovers from by requesting the failed part again
+RETRY_ERRORS = (
+    FileReferenceExpired,
+    FloodWait,
+    InternalServerError,
+    ServiceUnavailable,
+    Unauthorized,
+    TimeoutError,
+    OSError,
+    AttributeError,
+)
+
+# Pending chunk cache writes, the event loop only keeps weak references to tasks
+CACHE_WRITES = set()
+
+
+def _discard_result(task: asyncio.Task) -> None:
+    # Retrieve the result of an abandoned prefetch task so its error is not reported as unhandled
+    if not task.cancelled():
+        task.exception()
+
+
+def cancel_tasks(tasks: deque) -> None:
+    while tasks:
+        task = tasks.popleft()
+        task.cancel()
+        task.add_done_callback(_discard_result)
+
 
 class ByteStreamer:
     def __init__(self, client: Client):
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
 
-    async def get_file_properties(self, channel, message_id: int) -> FileId:
-        if message_id not in self.cached_file_ids:
-            await self.generate_file_properties(channel, message_id)
-        return self.cached_file_ids[message_id]
+    async def get_file_properties(self, channel, message_id: int, file=None) -> FileId:
+        """
+        Returns the FileId of a message, built from the properties stored on the
+        drive File node when available so no message has to be fetched.
+        """
+        file_id = FILE_ID_CACHE.get(message_id)
+        if file_id is None:
+            file_id = get_stored_file_ids(file, channel) if file else None
+            if file_id:
+                FILE_ID_CACHE.put(message_id, file_id)
+            else:
+                file_id = await self.generate_file_properties(channel, message_id)
+        return file_id
 
     async def generate_file_properties(self, channel, message_id: int) -> FileId:
+        from utils.directoryHandler import DRIVE_DATA
+
         file_id = await get_file_ids(self.client, channel, message_id)
         if not file_id:
             raise Exception("FileNotFound")
-        self.cached_file_ids[message_id] = file_id
-        return self.cached_file_ids[message_id]
+        FILE_ID_CACHE.put(message_id, file_id)
 
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
+        # Record the properties on the drive so the next stream needs no message fetch
+        if DRIVE_DATA:
+            DRIVE_DATA.set_file_properties(
+                message_id,
+                file_id.encoded,
+                file_id.dc_id,
+                file_id.mime_type or None,
+                file_id.thumbs,
+            )
+        return file_id
+
+    async def refresh_file_properties(self, file_id: FileId) -> FileId:
         """
-        Generates the media session for the DC that contains the media file.
-        This is required for getting the bytes from Telegram servers.
+        Refetches the message of a file whose file reference has expired.
         """
+        logger.info(f"Refreshing file reference of message {file_id.message_id}")
+        return await self.generate_file_properties(file_id.channel, file_id.message_id)
 
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-
-                for _ in range(6):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                    )
-
-                    try:
-                        await media_session.invoke(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id, bytes=exported_auth.bytes
-                            )
-                        )
-                        break
-                    except AuthBytesInvalid:
-                        logger.debug(
-                            f"Invalid authorization bytes for DC {file_id.dc_id}"
-                        )
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logger.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logger.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
+    async def generate_media_session(
+        self, client: Client, file_id: FileId
+    ) -> MediaSessionPool:
+        """
+        Returns the pool of media sessions for the DC that contains the media file.
+        This is required for getting the bytes from Telegram servers.
+        """
+        return await get_session_pool(client, file_id.dc_id)
 
     @staticmethod
     async def get_location(
@@ -134,6 +152,204 @@ class ByteStreamer:
             )
         return location
 
+    @staticmethod
+    def get_part_key(file_id: FileId, offset: int, chunk_size: int) -> Optional[PartKey]:
+        """
+        Returns the chunk cache key of a file part, None for media that is not cached.
+        """
+        if file_id.file_type in (FileType.CHAT_PHOTO, FileType.THUMBNAIL):
+            return None
+        return (file_id.media_id, offset, chunk_size)
+
+    async def get_part(
+        self,
+        file_id: FileId,
+        media_session: MediaSessionPool,
+        location: Union[
+            raw.types.InputPhotoFileLocation,
+            raw.types.InputDocumentFileLocation,
+            raw.types.InputPeerPhotoFileLocation,
+        ],
+        offset: int,
+        chunk_size: int,
+        flow: Optional[Flow] = None,
+    ) -> bytes:
+        """
+        Fetches a single part of the media file, returns empty bytes at the end of the file.
+        Concurrent requests for the same part share a single fetch.
+        """
+        key = self.get_part_key(file_id, offset, chunk_size)
+        if key is None:
+            return await self.fetch_part(
+                None, media_session, location, offset, chunk_size, flow
+            )
+
+        chunk = HOT_PARTS.get(key)
+        if chunk is not None:
+            return chunk
+
+        return await PART_FLIGHTS.run(
+            key,
+            lambda: self.fetch_part(
+                key, media_session, location, offset, chunk_size, flow
+            ),
+        )
+
+    async def fetch_part(
+        self,
+        key: Optional[PartKey],
+        media_session: MediaSessionPool,
+        location: Union[
+            raw.types.InputPhotoFileLocation,
+            raw.types.InputDocumentFileLocation,
+            raw.types.InputPeerPhotoFileLocation,
+        ],
+        offset: int,
+        chunk_size: int,
+        flow: Optional[Flow] = None,
+    ) -> bytes:
+        """
+        Reads a part from the chunk cache or requests it from Telegram, then caches it.
+        Telegram requests wait for a GetFile slot of the client given out by the scheduler.
+        """
+        if key and CHUNK_CACHE.enabled:
+            chunk = await CHUNK_CACHE.get(key)
+            if chunk is not None:
+                HOT_PARTS.put(key, chunk)
+                return chunk
+
+        async with STREAM_SCHEDULER.slot(media_session.client, flow, chunk_size):
+            r = await media_session.invoke(
+                raw.functions.upload.GetFile(
+                    location=location, offset=offset, limit=chunk_size
+                ),
+            )
+        if not isinstance(r, raw.types.upload.File):
+            return b""
+
+        if flow:
+            flow.bytes_fetched += len(r.bytes)
+
+        if key:
+            HOT_PARTS.put(key, r.bytes)
+            if CHUNK_CACHE.enabled:
+                task = asyncio.create_task(CHUNK_CACHE.put(key, r.bytes))
+                CACHE_WRITES.add(task)
+                task.add_done_callback(CACHE_WRITES.discard)
+        return r.bytes
+
+    async def get_stripe_sources(
+        self, file_id: FileId, stripes: List[Tuple["ByteStreamer", FileId]]
+    ) -> list:
+        """
+        Returns the (media session, location) pairs used to fetch the parts of a stream.
+        The first pair always belongs to this client, stripe clients that fail to connect are skipped.
+        """
+        media_session = await self.generate_media_session(self.client, file_id)
+        sources = [(media_session, await self.get_location(file_id))]
+
+        results = await asyncio.gather(
+            *(
+                streamer.generate_media_session(streamer.client, stripe_file_id)
+                for streamer, stripe_file_id in stripes
+            ),
+            return_exceptions=True,
+        )
+        for (streamer, stripe_file_id), result in zip(stripes, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Skipping stripe client, media session failed: {result}")
+                continue
+            sources.append((result, await streamer.get_location(stripe_file_id)))
+        return sources
+
+    async def get_failover_source(self, file_id: FileId, sources: list) -> Optional[tuple]:
+        """
+        Returns a (media session, location) pair of a client not used by the stream yet.
+        """
+        from utils.clients import has_dc_session, multi_clients
+
+        in_use = {media_session.client for media_session, _ in sources}
+        # Clients that already have a session for the DC of the file take over fastest
+        clients = sorted(
+            multi_clients.values(),
+            key=lambda client: not has_dc_session(client.name, file_id.dc_id),
+        )
+        for client in clients:
+            if client in in_use or not get_health(client).available:
+                continue
+            try:
+                media_session = await self.generate_media_session(client, file_id)
+            except Exception as e:
+                logger.warning(f"Failover client unavailable: {e!r}")
+                continue
+            logger.info(f"Failing over stream to client {client.name}")
+            return media_session, await self.get_location(file_id)
+        return None
+
+    async def refresh_sources(self, file_id: FileId, sources: list) -> list:
+        """
+        Returns the sources with fresh file references. File references are resolved per
+        client, so the sources of other clients refetch the message with their own client
+        and are dropped when that fails.
+        """
+
+        async def refresh(media_session):
+            if media_session.client is self.client:
+                return media_session, await self.get_location(file_id)
+            client_file_id = await get_file_ids(
+                media_session.client, file_id.channel, file_id.message_id
+            )
+            return media_session, await self.get_location(client_file_id)
+
+        results = await asyncio.gather(
+            *(refresh(media_session) for media_session, _ in sources),
+            return_exceptions=True,
+        )
+        refreshed = [result for result in results if not isinstance(result, Exception)]
+        if not refreshed:
+            raise results[0]
+        if len(refreshed) < len(results):
+            logger.warning(
+                f"Dropped {len(results) - len(refreshed)} stream sources, "
+                "their file reference could not be refreshed"
+            )
+        return refreshed
+
+    async def recover_stream(
+        self,
+        error: Exception,
+        file_id: FileId,
+        sources: list,
+        failed_index: int,
+        attempt: int,
+    ) -> Tuple[FileId, list]:
+        """
+        Prepares a stream to request a failed part again, returns the (file_id, sources) to use.
+        """
+        sources = list(sources)
+
+        if isinstance(error, FileReferenceExpired):
+            file_id = await self.refresh_file_properties(file_id)
+            return file_id, await self.refresh_sources(file_id, sources)
+
+        if isinstance(error, FloodWait):
+            source = await self.get_failover_source(file_id, sources)
+            if source:
+                sources[failed_index] = source
+            elif error.value <= config.SLEEP_THRESHOLD:
+                await asyncio.sleep(error.value)
+            else:
+                raise error
+            return file_id, sources
+
+        # Network or Telegram server error, back off and move to another client if it keeps failing
+        await asyncio.sleep(min(0.5 * 2 ** (attempt - 1), 8))
+        if attempt >= 2:
+            source = await self.get_failover_source(file_id, sources)
+            if source:
+                sources[failed_index] = source
+        return file_id, sources
+
     async def yield_file(
         self,
         file_id: FileId,
@@ -142,58 +358,87 @@ class ByteStreamer:
         last_part_cut: int,
         part_count: int,
         chunk_size: int,
+        stripes: List[Tuple["ByteStreamer", FileId]] = None,
+        flow: Optional[Flow] = None,
     ):
         """
         Custom generator that yields the bytes of the media file.
+        Keeps up to STREAM_PREFETCH_PARTS requests in flight while the parts are yielded in order.
+        When stripes are given, the parts are fetched round robin from this client and the stripe clients.
+        A failed part is retried from its exact offset, refreshing the file reference or moving
+        to another client when needed, up to STREAM_MAX_RETRIES times.
         """
-        client = self.client
         logger.debug(f"Starting to yielding file with client.")
-        media_session = await self.generate_media_session(client, file_id)
+        sources = await self.get_stripe_sources(file_id, stripes or [])
 
         current_part = 1
-        location = await self.get_location(file_id)
+        next_part = 1
+
+        # Never buffer more than STREAM_MAX_BUFFER bytes ahead of the client
+        window = max(
+            1,
+            min(
+                config.STREAM_PREFETCH_PARTS * len(sources),
+                config.STREAM_MAX_BUFFER // chunk_size,
+            ),
+        )
+        pending = deque()
+        attempt = 0
 
         try:
-            r = await media_session.invoke(
-                raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
-                ),
-            )
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.invoke(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
+            while current_part <= part_count:
+                while next_part <= part_count and len(pending) < window:
+                    part_offset = offset + (next_part - 1) * chunk_size
+                    media_session, location = sources[(next_part - 1) % len(sources)]
+                    pending.append(
+                        asyncio.create_task(
+                            self.get_part(
+                                file_id,
+                                media_session,
+                                location,
+                                part_offset,
+                                chunk_size,
+                                flow,
+                            )
+                        )
+                    )
+                    next_part += 1
+
+                try:
+                    chunk = await pending.popleft()
+                except RETRY_ERRORS as e:
+                    attempt += 1
+                    if attempt > config.STREAM_MAX_RETRIES:
+                        logger.error(
+                            f"Giving up on part {current_part} after {attempt - 1} retries: {e!r}"
+                        )
+                        raise
+
+                    # Request the failed part and everything after it again, from the exact offset
+                    logger.warning(
+                        f"Retrying part {current_part} (attempt {attempt}): {e!r}"
+                    )
+                    cancel_tasks(pending)
+                    failed_index = (current_part - 1) % len(sources)
+                    next_part = current_part
+                    file_id, sources = await self.recover_stream(
+                        e, file_id, sources, failed_index, attempt
                     )
-        except (TimeoutError, AttributeError):
-            pass
+                    continue
+
+                attempt = 0
+                if not chunk:
+                    break
+                elif part_count == 1:
+                    yield chunk[first_part_cut:last_part_cut]
+                elif current_part == 1:
+                    yield chunk[first_part_cut:]
+                elif current_part == part_count:
+                    yield chunk[:last_part_cut]
+                else:
+                    yield chunk
+
+                current_part += 1
         finally:
+            cancel_tasks(pending)
             logger.debug(f"Finished yielding file with {current_part} parts.")
-
-    async def clean_cache(self) -> None:
-        """
-        function to clean the cache to reduce memory usage
-        """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logger.debug("Cleaned the cache")
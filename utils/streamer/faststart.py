@@ -0,0 +1,178 @@
+import struct
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from utils.logger import Logger
+from utils.streamer.part_cache import SingleFlight
+
+logger = Logger(__name__)
+
+# Container boxes walked to find the chunk offset tables of every track
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+# Files with a larger moov box are served as they are
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+# Number of parsed box layouts kept in memory
+LAYOUT_CACHE_SIZE = 64
+
+FASTSTART_MIME_TYPES = ("video/mp4", "video/quicktime", "video/x-m4v", "audio/mp4")
+
+
+class FaststartLayout:
+    """
+    Virtual byte layout of an MP4 file with its moov box moved in front of the media data.
+    Segments are (virtual start, length, original offset or None, moov bytes or None).
+    """
+
+    def __init__(self, segments: List[Tuple[int, int, Optional[int], Optional[bytes]]]):
+        self.segments = segments
+
+    def split_range(self, from_bytes: int, until_bytes: int):
+        """
+        Maps a virtual byte range to ("file", start, end) pieces of the original file
+        and ("data", bytes) pieces of the relocated moov box, in order.
+        """
+        for start, length, source_offset, data in self.segments:
+            end = start + length - 1
+            if end < from_bytes or start > until_bytes:
+                continue
+            piece_start = max(start, from_bytes) - start
+            piece_end = min(end, until_bytes) - start
+            if data is not None:
+                yield "data", data[piece_start : piece_end + 1]
+            else:
+                yield "file", source_offset + piece_start, source_offset + piece_end
+
+
+def parse_box_header(header: bytes, offset: int, file_size: int) -> Tuple[bytes, int, int]:
+    """
+    Returns the (type, size, header size) of the box starting at offset.
+    """
+    size, box_type = struct.unpack(">I4s", header[:8])
+    header_size = 8
+    if size == 1:
+        size = struct.unpack(">Q", header[8:16])[0]
+        header_size = 16
+    elif size == 0:
+        size = file_size - offset
+    if size < header_size:
+        raise ValueError(f"Invalid {box_type!r} box size {size} at offset {offset}")
+    return box_type, size, header_size
+
+
+def shift_chunk_offsets(
+    moov: bytearray, start: int, end: int, shift_from: int, shift_until: int, shift: int
+) -> None:
+    """
+    Adds shift to every stco/co64 chunk offset in [shift_from, shift_until) inside moov[start:end].
+    """
+    offset = start
+    while offset + 8 <= end:
+        box_type, size, header_size = parse_box_header(
+            bytes(moov[offset : offset + 16]), offset, end
+        )
+        box_end = min(offset + size, end)
+
+        if box_type in CONTAINER_BOXES:
+            shift_chunk_offsets(
+                moov, offset + header_size, box_end, shift_from, shift_until, shift
+            )
+        elif box_type in (b"stco", b"co64"):
+            entry_format, entry_size = (">I", 4) if box_type == b"stco" else (">Q", 8)
+            entries_start = offset + header_size + 8  # version, flags and entry count
+            (count,) = struct.unpack(">I", moov[entries_start - 4 : entries_start])
+            for index in range(count):
+                position = entries_start + index * entry_size
+                (value,) = struct.unpack(entry_format, moov[position : position + entry_size])
+                if shift_from <= value < shift_until:
+                    value += shift
+                    if box_type == b"stco" and value > 0xFFFFFFFF:
+                        raise OverflowError("Chunk offset does not fit in stco")
+                    struct.pack_into(entry_format, moov, position, value)
+
+        offset += size
+
+
+async def build_faststart_layout(read_bytes, file_size: int) -> Optional[FaststartLayout]:
+    """
+    Walks the top level boxes with small range reads and builds the faststart layout.
+    Returns None when the file is already faststart or can not be rewritten.
+    """
+    # Only the boxes up to the first mdat and the moov are needed, the walk stops there so
+    # fragmented files with thousands of moof and mdat boxes are not read box by box
+    mdat_offset = None
+    moov_offset = moov_size = None
+    offset = 0
+    while offset + 8 <= file_size:
+        header = await read_bytes(offset, min(offset + 15, file_size - 1))
+        box_type, size, _ = parse_box_header(header, offset, file_size)
+        if box_type == b"moov":
+            if mdat_offset is None:
+                # Already faststart
+                return None
+            moov_offset, moov_size = offset, size
+            break
+        if box_type == b"mdat" and mdat_offset is None:
+            mdat_offset = offset
+        offset += size
+
+    if moov_offset is None or mdat_offset is None:
+        return None
+
+    if moov_size > MAX_MOOV_SIZE:
+        logger.info(f"Skipping faststart, moov box of {moov_size} bytes is too large")
+        return None
+
+    # Media data between the first mdat and the moov moves back by the size of the moov
+    insert_offset = mdat_offset
+    moov = bytearray(await read_bytes(moov_offset, moov_offset + moov_size - 1))
+    try:
+        shift_chunk_offsets(
+            moov, 0, len(moov), insert_offset, moov_offset, moov_size
+        )
+    except (OverflowError, ValueError, struct.error) as e:
+        logger.info(f"Skipping faststart, moov box can not be rewritten: {e}")
+        return None
+
+    segments = []
+    virtual_offset = 0
+
+    def add_segment(length, source_offset=None, data=None):
+        nonlocal virtual_offset
+        if length > 0:
+            segments.append((virtual_offset, length, source_offset, data))
+            virtual_offset += length
+
+    add_segment(insert_offset, 0)
+    add_segment(moov_size, data=bytes(moov))
+    add_segment(moov_offset - insert_offset, insert_offset)
+    add_segment(file_size - moov_offset - moov_size, moov_offset + moov_size)
+    return FaststartLayout(segments)
+
+
+LAYOUT_CACHE: "OrderedDict[int, Optional[FaststartLayout]]" = OrderedDict()
+LAYOUT_FLIGHTS = SingleFlight()
+
+
+async def get_faststart_layout(
+    media_id: int, read_bytes, file_size: int
+) -> Optional[FaststartLayout]:
+    """
+    Returns the cached faststart layout of a file, parsing its boxes on the first request.
+    """
+    if media_id in LAYOUT_CACHE:
+        LAYOUT_CACHE.move_to_end(media_id)
+        return LAYOUT_CACHE[media_id]
+
+    async def parse():
+        try:
+            layout = await build_faststart_layout(read_bytes, file_size)
+        except (ValueError, struct.error) as e:
+            logger.warning(f"Failed to parse MP4 boxes of media {media_id}: {e}")
+            layout = None
+        LAYOUT_CACHE[media_id] = layout
+        while len(LAYOUT_CACHE) > LAYOUT_CACHE_SIZE:
+            LAYOUT_CACHE.popitem(last=False)
+        return layout
+
+    return await LAYOUT_FLIGHTS.run(media_id, parse)
@@ -0,0 +1,50 @@
+import config, time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from pyrogram.file_id import FileId
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+
+class FileIdCache:
+    """
+    Process wide LRU cache of resolved FileIds keyed by message id, shared by every client.
+    Entries expire after ttl seconds and the least recently used ones are evicted over max_size.
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[int, Tuple[float, FileId]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_id: int) -> Optional[FileId]:
+        entry = self.entries.get(message_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[message_id]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(message_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, message_id: int, file_id: FileId) -> None:
+        self.entries[message_id] = (time.monotonic() + self.ttl, file_id)
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+FILE_ID_CACHE = FileIdCache(config.FILE_ID_CACHE_SIZE, config.FILE_ID_CACHE_TTL)
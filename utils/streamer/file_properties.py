@@ -29,9 +29,57 @@ async def get_file_ids(client: Client, chat_id, message_id) -> Optional[FileId]:
     setattr(file_id, "mime_type", getattr(media, "mime_type", ""))
     setattr(file_id, "file_name", getattr(media, "file_name", ""))
     setattr(file_id, "unique_id", file_unique_id)
+    setattr(file_id, "encoded", media.file_id)
+    setattr(file_id, "channel", chat_id)
+    setattr(file_id, "message_id", int(message_id))
+    setattr(file_id, "thumbs", get_thumbs(media))
     return file_id
 
 
+def get_stored_file_ids(file, channel) -> Optional[FileId]:
+    """
+    Builds the FileId from the Telegram file properties stored on a drive File node,
+    returns None for files stored before those properties were recorded.
+    """
+    encoded = getattr(file, "tg_file_id", None)
+    if not encoded:
+        return None
+
+    file_id = FileId.decode(encoded)
+    setattr(file_id, "file_size", file.size)
+    setattr(file_id, "mime_type", getattr(file, "mime_type", None) or "")
+    setattr(file_id, "file_name", file.name)
+    setattr(file_id, "unique_id", None)
+    setattr(file_id, "encoded", encoded)
+    setattr(file_id, "channel", channel)
+    setattr(file_id, "message_id", int(file.file_id))
+    setattr(file_id, "thumbs", getattr(file, "thumbs", None))
+    return file_id
+
+
+def get_media_properties(message: "Message") -> dict:
+    """
+    Returns the Telegram file properties of a message's media, as stored on drive File nodes.
+    """
+    media = get_media_from_message(message)
+    return {
+        "tg_file_id": media.file_id,
+        "dc_id": FileId.decode(media.file_id).dc_id,
+        "mime_type": getattr(media, "mime_type", None),
+        "thumbs": get_thumbs(media),
+    }
+
+
+def get_thumbs(media: Any) -> list:
+    """
+    Returns the [thumbnail size type, width, height] of every Telegram thumbnail of a media.
+    """
+    return [
+        [FileId.decode(thumb.file_id).thumbnail_size, thumb.width, thumb.height]
+        for thumb in getattr(media, "thumbs", None) or []
+    ]
+
+
 def get_media_from_message(message: "Message") -> Any:
     media_types = (
         "audio",
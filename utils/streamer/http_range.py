@@ -0,0 +1,177 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+# Requests asking for more ranges than this are served as a whole file instead
+MAX_RANGES = 16
+
+ByteRange = Tuple[int, int]  # (first byte, last byte), both inclusive
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[List[ByteRange]]:
+    """
+    Parses a Range header (RFC 7233) into sorted, merged byte ranges.
+    Returns None when the header should be ignored and the whole file served,
+    raises RangeNotSatisfiable when no range overlaps the file.
+    """
+    if not range_header:
+        return None
+
+    unit, _, ranges_spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not ranges_spec.strip():
+        return None
+
+    specs = [spec.strip() for spec in ranges_spec.split(",") if spec.strip()]
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition("-")
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if first == "":
+                # Suffix range, the last N bytes of the file
+                suffix_length = int(last)
+                if suffix_length < 0:
+                    return None
+                if suffix_length == 0:
+                    continue
+                ranges.append((max(0, file_size - suffix_length), file_size - 1))
+            else:
+                start = int(first)
+                end = int(last) if last else None
+                if start < 0 or (end is not None and end < start):
+                    return None
+                if start >= file_size:
+                    continue
+                if end is None:
+                    end = file_size - 1
+                ranges.append((start, min(end, file_size - 1)))
+        except ValueError:
+            return None
+
+    if not ranges:
+        raise RangeNotSatisfiable
+
+    # Merge overlapping and adjacent ranges so no byte is sent twice
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def parse_http_date(value: str) -> Optional[datetime]:
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def format_http_date(date: datetime) -> str:
+    return format_datetime(date.astimezone(timezone.utc), usegmt=True)
+
+
+def etag_matches(header: str, etag: str, weak: bool) -> bool:
+    """
+    Checks an If-Match / If-None-Match header against the entity tag.
+    If-None-Match uses the weak comparison, If-Match and If-Range the strong one.
+    """
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def evaluate_preconditions(
+    headers, etag: str, last_modified: datetime
+) -> Optional[int]:
+    """
+    Evaluates the conditional request headers (RFC 7232) of a GET or HEAD request,
+    returns 412 or 304 when the request should not be served, otherwise None.
+    """
+    last_modified = last_modified.replace(microsecond=0)
+
+    if_match = headers.get("If-Match")
+    if if_match is not None:
+        if not etag_matches(if_match, etag, weak=False):
+            return 412
+    else:
+        if_unmodified_since = parse_http_date(headers.get("If-Unmodified-Since", ""))
+        if if_unmodified_since and last_modified > if_unmodified_since:
+            return 412
+
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag, weak=True):
+            return 304
+    else:
+        if_modified_since = parse_http_date(headers.get("If-Modified-Since", ""))
+        if if_modified_since and last_modified <= if_modified_since:
+            return 304
+
+    return None
+
+
+def if_range_matches(headers, etag: str, last_modified: datetime) -> bool:
+    """
+    Returns False when an If-Range header no longer matches, the Range header must then be ignored.
+    """
+    if_range = headers.get("If-Range")
+    if not if_range:
+        return True
+
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return etag_matches(if_range, etag, weak=False)
+
+    date = parse_http_date(if_range)
+    return date is not None and last_modified.replace(microsecond=0) == date
+
+
+def multipart_part_header(
+    boundary: str, content_type: str, byte_range: ByteRange, file_size: int
+) -> bytes:
+    return (
+        f"\r\n--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: bytes {byte_range[0]}-{byte_range[1]}/{file_size}\r\n\r\n"
+    ).encode()
+
+
+def multipart_end(boundary: str) -> bytes:
+    return f"\r\n--{boundary}--\r\n".encode()
+
+
+def multipart_length(
+    boundary: str, content_type: str, ranges: List[ByteRange], file_size: int
+) -> int:
+    """
+    Returns the exact Content-Length of a multipart/byteranges body.
+    """
+    length = len(multipart_end(boundary))
+    for byte_range in ranges:
+        length += len(multipart_part_header(boundary, content_type, byte_range, file_size))
+        length += byte_range[1] - byte_range[0] + 1
+    return length
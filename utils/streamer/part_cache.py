@@ -0,0 +1,68 @@
+import asyncio, config
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+from utils.streamer.chunk_cache import PartKey
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+
+class HotPartCache:
+    """
+    Small in-memory LRU cache of recently streamed file parts, bounded by bytes.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.entries: "OrderedDict[PartKey, bytes]" = OrderedDict()
+
+    def get(self, key: PartKey) -> Optional[bytes]:
+        chunk = self.entries.get(key)
+        if chunk is not None:
+            self.entries.move_to_end(key)
+        return chunk
+
+    def put(self, key: PartKey, chunk: bytes) -> None:
+        if not chunk or len(chunk) > self.max_size or key in self.entries:
+            return
+
+        self.entries[key] = chunk
+        self.size += len(chunk)
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent fetches of the same file part into a single request,
+    every caller waiting on a key receives the bytes of the one in-flight fetch.
+    """
+
+    def __init__(self):
+        self.flights: Dict[PartKey, asyncio.Task] = {}
+        self.coalesced = 0
+
+    def finish(self, key: PartKey, task: asyncio.Task) -> None:
+        self.flights.pop(key, None)
+        # Retrieve the error here too, the waiters may all be gone already
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key: PartKey, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch())
+            self.flights[key] = task
+            task.add_done_callback(lambda _: self.finish(key, task))
+        else:
+            self.coalesced += 1
+            logger.debug(f"Joined in-flight fetch of part {key}")
+
+        # A waiter going away (client disconnect) must not cancel the fetch for the others
+        return await asyncio.shield(task)
+
+
+HOT_PARTS = HotPartCache(config.HOT_PART_CACHE_SIZE)
+PART_FLIGHTS = SingleFlight()
@@ -0,0 +1,178 @@
+import asyncio, config, heapq, itertools, time, weakref
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from pyrogram import Client
+from utils.client_health import TokenBucket
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Traffic classes, playback ranges get a larger share of the GetFile slots than downloads
+INTERACTIVE = "interactive"
+BULK = "bulk"
+CLASS_WEIGHTS = {INTERACTIVE: 4, BULK: 1}
+
+
+class Flow:
+    """
+    A stream competing for GetFile slots. Its finish tag advances by cost / weight for every
+    request, so flows with a larger weight are served proportionally more often.
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, name: str, kind: str, shared: bool):
+        self.id = next(Flow.ids)
+        self.name = name
+        self.kind = kind
+        self.shared = shared
+        self.weight = CLASS_WEIGHTS[kind]
+        self.finish_tag = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.bytes_fetched = 0
+        self.started = time.monotonic()
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-3)
+        return {
+            "id": self.id,
+            "name": self.name,
+            "class": self.kind,
+            "shared": self.shared,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "bytes_fetched": self.bytes_fetched,
+            "rate": int(self.bytes_fetched / elapsed),
+        }
+
+
+class SlotQueue:
+    """
+    Weighted fair queue (start time fair queuing) of the GetFile slots of one client.
+    """
+
+    def __init__(self, client: Client, slots: int):
+        self.client = client
+        self.slots = slots
+        self.busy = 0
+        self.virtual_time = 0.0
+        self.queue = []
+        self.sequence = itertools.count()
+
+    async def acquire(self, flow: Flow, cost: int) -> None:
+        start = max(self.virtual_time, flow.finish_tag)
+        flow.finish_tag = start + cost / flow.weight
+
+        if self.busy < self.slots and not self.queue:
+            self.busy += 1
+            self.virtual_time = start
+            flow.in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self.queue, (flow.finish_tag, next(self.sequence), start, waiter, flow)
+        )
+        flow.queued += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # The slot may have been granted right before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.busy -= 1
+                self.dispatch()
+            raise
+        flow.in_flight += 1
+
+    def release(self, flow: Flow) -> None:
+        self.busy -= 1
+        flow.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        while self.busy < self.slots and self.queue:
+            _, _, start, waiter, flow = heapq.heappop(self.queue)
+            flow.queued -= 1
+            if waiter.cancelled():
+                continue
+            self.busy += 1
+            self.virtual_time = start
+            waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "client": self.client.name,
+            "slots": self.slots,
+            "busy": self.busy,
+            "queued": len(self.queue),
+        }
+
+
+class StreamScheduler:
+    """
+    Hands out the GetFile slots of every client to the open streams with weighted fair
+    queuing. Shared link streams additionally share one bandwidth ceiling.
+    The memory of every stream is bounded by its prefetch window (STREAM_MAX_BUFFER),
+    a stream waiting for slots stops reading ahead so slow consumers apply backpressure.
+    """
+
+    def __init__(self, slots: int, shared_rate: int):
+        self.slots = slots
+        self.queues: Dict[Client, SlotQueue] = {}
+        # Flows of streams that were never started disappear with their generator
+        self.flows: Dict[int, Flow] = weakref.WeakValueDictionary()
+        self.shared_bucket = (
+            TokenBucket(shared_rate, shared_rate) if shared_rate > 0 else None
+        )
+
+    def open_flow(
+        self, name: str, kind: str = INTERACTIVE, shared: bool = False
+    ) -> Flow:
+        flow = Flow(name, kind, shared)
+        self.flows[flow.id] = flow
+        return flow
+
+    def close_flow(self, flow: Optional[Flow]) -> None:
+        if flow is not None:
+            self.flows.pop(flow.id, None)
+
+    def get_queue(self, client: Client) -> SlotQueue:
+        queue = self.queues.get(client)
+        if queue is None:
+            queue = SlotQueue(client, self.slots)
+            self.queues[client] = queue
+        return queue
+
+    @asynccontextmanager
+    async def slot(self, client: Client, flow: Optional[Flow], cost: int):
+        """
+        Holds a GetFile slot of the client for the duration of the block.
+        Requests without a flow (thumbnails, box parsing) bypass the queue.
+        """
+        if flow is None:
+            yield
+            return
+
+        if flow.shared and self.shared_bucket:
+            await self.shared_bucket.consume(cost)
+
+        queue = self.get_queue(client)
+        await queue.acquire(flow, cost)
+        try:
+            yield
+        finally:
+            queue.release(flow)
+
+    def stats(self) -> dict:
+        flows: List[Flow] = list(self.flows.values())
+        return {
+            "clients": [queue.stats() for queue in self.queues.values()],
+            "flows": [flow.stats() for flow in flows],
+            "shared_rate_limit": self.shared_bucket.rate if self.shared_bucket else 0,
+        }
+
+
+STREAM_SCHEDULER = StreamScheduler(
+    config.GETFILE_SLOTS_PER_CLIENT, config.SHARED_LINK_RATE_LIMIT
+)
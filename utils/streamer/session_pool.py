@@ -0,0 +1,390 @@
+import asyncio, config, os, random, time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from pyrogram import Client, raw
+from pyrogram.session import Session, Auth
+from pyrogram.errors import (
+    AuthBytesInvalid,
+    FloodWait,
+    InternalServerError,
+    ServiceUnavailable,
+    Unauthorized,
+)
+from utils.client_health import get_health
+from utils.clients import record_latency, set_session_warm
+from utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Extra sessions idle for longer than this are closed, the first session of a pool is kept
+IDLE_TIMEOUT = 5 * 60
+
+# A session is replaced after this many consecutive failed requests
+MAX_FAILURES = 3
+
+# Seconds an idle session has to answer a ping before it is replaced
+PING_TIMEOUT = 10
+
+
+class PooledSession:
+    def __init__(self, session: Session):
+        self.session = session
+        self.in_flight = 0
+        self.failures = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def healthy(self) -> bool:
+        # Pyrogram reconnects dropped sessions by itself, only repeated failures mark one as broken
+        return self.failures < MAX_FAILURES
+
+
+class MediaSessionPool:
+    """
+    Pool of media sessions of a client for one DC. Requests go to the least loaded healthy
+    session, a new session is opened when all of them are busy, up to MEDIA_SESSIONS_PER_DC.
+    Exposes invoke() and client like a pyrogram Session so it can be used in its place.
+    """
+
+    def __init__(self, client: Client, dc_id: int):
+        self.client = client
+        self.dc_id = dc_id
+        self.sessions: List[PooledSession] = []
+        self.auth_key: bytes = None
+        self.lock = asyncio.Lock()
+        self.growing = False
+
+    async def get_auth_key(self) -> bytes:
+        """
+        Returns the auth key of the DC, exporting the client's authorization to it when it is not the home DC.
+        All sessions of the pool share this key.
+        """
+        client = self.client
+        if self.auth_key is not None:
+            return self.auth_key
+
+        if self.dc_id == await client.storage.dc_id():
+            self.auth_key = await client.storage.auth_key()
+            return self.auth_key
+
+        # The key exported by a previous run is still authorized, reusing it skips the export
+        auth_key = self.load_auth_key()
+        if auth_key is not None:
+            logger.debug(f"Reusing stored auth key for DC {self.dc_id}")
+            self.auth_key = auth_key
+            return self.auth_key
+
+        auth_key = await Auth(
+            client, self.dc_id, await client.storage.test_mode()
+        ).create()
+        session = Session(
+            client,
+            self.dc_id,
+            auth_key,
+            await client.storage.test_mode(),
+            is_media=True,
+        )
+        await session.start()
+
+        for _ in range(6):
+            exported_auth = await client.invoke(
+                raw.functions.auth.ExportAuthorization(dc_id=self.dc_id)
+            )
+
+            try:
+                await session.invoke(
+                    raw.functions.auth.ImportAuthorization(
+                        id=exported_auth.id, bytes=exported_auth.bytes
+                    )
+                )
+                break
+            except AuthBytesInvalid:
+                logger.debug(f"Invalid authorization bytes for DC {self.dc_id}")
+                continue
+        else:
+            await session.stop()
+            raise AuthBytesInvalid
+
+        self.auth_key = auth_key
+        self.save_auth_key(auth_key)
+        self.sessions.append(PooledSession(session))
+        return self.auth_key
+
+    def get_auth_key_path(self) -> Optional[Path]:
+        # Keys are stored per account, client names only reflect the order of the tokens
+        me = getattr(self.client, "me", None)
+        if me is None:
+            return None
+        return Path(config.SESSION_DIR) / str(me.id) / f"media_dc_{self.dc_id}.key"
+
+    def load_auth_key(self) -> Optional[bytes]:
+        path = self.get_auth_key_path()
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def save_auth_key(self, auth_key: bytes) -> None:
+        path = self.get_auth_key_path()
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(auth_key)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to store auth key for DC {self.dc_id}: {e}")
+
+    def reset_auth(self) -> None:
+        """
+        Forgets a revoked auth key and closes its sessions, the next request exports a new one.
+        """
+        logger.warning(
+            f"Auth key for DC {self.dc_id} of client {self.client.name} was revoked"
+        )
+        path = self.get_auth_key_path()
+        if path is not None:
+            path.unlink(missing_ok=True)
+        self.auth_key = None
+        for pooled in list(self.sessions):
+            self.remove_session(pooled)
+
+    async def add_session(self) -> PooledSession:
+        sessions_count = len(self.sessions)
+        auth_key = await self.get_auth_key()
+
+        # Exporting the authorization already opened the first session
+        if len(self.sessions) > sessions_count:
+            pooled = self.sessions[-1]
+        else:
+            session = Session(
+                self.client,
+                self.dc_id,
+                auth_key,
+                await self.client.storage.test_mode(),
+                is_media=True,
+            )
+            await session.start()
+            pooled = PooledSession(session)
+            self.sessions.append(pooled)
+
+        if self.client.media_sessions.get(self.dc_id) is None:
+            self.client.media_sessions[self.dc_id] = pooled.session
+        set_session_warm(self.client, self.dc_id, True)
+        logger.debug(
+            f"Created media session {len(self.sessions)} for DC {self.dc_id} of client {self.client.name}"
+        )
+        return pooled
+
+    def remove_session(self, pooled: PooledSession) -> None:
+        if pooled in self.sessions:
+            self.sessions.remove(pooled)
+        if self.client.media_sessions.get(self.dc_id) is pooled.session:
+            if self.sessions:
+                self.client.media_sessions[self.dc_id] = self.sessions[0].session
+            else:
+                self.client.media_sessions.pop(self.dc_id, None)
+        if not self.sessions:
+            set_session_warm(self.client, self.dc_id, False)
+        asyncio.create_task(self.stop_session(pooled.session))
+
+    async def stop_session(self, session: Session) -> None:
+        try:
+            await session.stop()
+        except Exception as e:
+            logger.debug(f"Error stopping media session for DC {self.dc_id}: {e}")
+
+    async def ensure_session(self) -> None:
+        if not self.sessions:
+            async with self.lock:
+                if not self.sessions:
+                    await self.add_session()
+
+    async def grow(self) -> None:
+        try:
+            async with self.lock:
+                if len(self.sessions) < config.MEDIA_SESSIONS_PER_DC:
+                    await self.add_session()
+        except Exception as e:
+            logger.warning(f"Failed to grow media session pool for DC {self.dc_id}: {e}")
+        finally:
+            self.growing = False
+
+    async def acquire(self) -> PooledSession:
+        for pooled in [p for p in self.sessions if not p.healthy]:
+            logger.warning(
+                f"Dropping unhealthy media session for DC {self.dc_id} of client {self.client.name}"
+            )
+            self.remove_session(pooled)
+
+        await self.ensure_session()
+        pooled = min(self.sessions, key=lambda p: p.in_flight)
+
+        # Every session is busy, open another one in the background for the next requests
+        if (
+            pooled.in_flight >= config.MEDIA_SESSION_MAX_LOAD
+            and len(self.sessions) < config.MEDIA_SESSIONS_PER_DC
+            and not self.growing
+        ):
+            self.growing = True
+            asyncio.create_task(self.grow())
+
+        pooled.in_flight += 1
+        pooled.last_used = time.monotonic()
+        return pooled
+
+    async def invoke(self, query, *args, **kwargs):
+        health = get_health(self.client)
+        await health.pace("download")
+
+        # FloodWaits are raised instead of slept on, so the stream can move to another client
+        kwargs.setdefault("sleep_threshold", 0)
+
+        pooled = await self.acquire()
+        started = time.monotonic()
+        try:
+            result = await pooled.session.invoke(query, *args, **kwargs)
+            pooled.failures = 0
+            health.record_success()
+            record_latency(self.client, time.monotonic() - started)
+            return result
+        except Unauthorized:
+            if self.dc_id != await self.client.storage.dc_id():
+                self.reset_auth()
+            raise
+        except (FloodWait, InternalServerError, ServiceUnavailable) as e:
+            health.record_error(e)
+            raise
+        except (TimeoutError, OSError) as e:
+            pooled.failures += 1
+            health.record_error(e)
+            raise
+        finally:
+            pooled.in_flight -= 1
+            pooled.last_used = time.monotonic()
+
+    async def ping(self) -> None:
+        """
+        Pings the idle sessions and replaces the ones that stopped answering, sessions
+        serving requests are checked by the requests themselves.
+        """
+        for pooled in list(self.sessions):
+            if pooled.in_flight:
+                continue
+            try:
+                await pooled.session.invoke(
+                    raw.functions.Ping(ping_id=random.getrandbits(63)),
+                    retries=0,
+                    timeout=PING_TIMEOUT,
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Media session for DC {self.dc_id} of client {self.client.name} "
+                    f"stopped answering: {e!r}"
+                )
+                self.remove_session(pooled)
+
+        await self.ensure_session()
+
+    async def shrink(self) -> None:
+        async with self.lock:
+            now = time.monotonic()
+            for pooled in self.sessions[1:]:
+                if pooled.in_flight == 0 and now - pooled.last_used > IDLE_TIMEOUT:
+                    logger.debug(f"Closing idle media session for DC {self.dc_id}")
+                    self.remove_session(pooled)
+
+    def stats(self) -> dict:
+        return {
+            "client": self.client.name,
+            "dc_id": self.dc_id,
+            "sessions": [
+                {"in_flight": p.in_flight, "healthy": p.healthy} for p in self.sessions
+            ],
+        }
+
+
+SESSION_POOLS: Dict[Tuple[Client, int], MediaSessionPool] = {}
+shrink_task: asyncio.Task = None
+
+
+async def shrink_session_pools() -> None:
+    """
+    Periodically closes the extra media sessions that went idle.
+    """
+    while True:
+        await asyncio.sleep(60)
+        for pool in list(SESSION_POOLS.values()):
+            try:
+                await pool.shrink()
+            except Exception as e:
+                logger.error(f"Error shrinking media session pool: {e}")
+
+
+async def warm_client_sessions(client: Client, dc_ids: List[int]) -> None:
+    from utils.clients import draining_clients, multi_clients
+
+    # The DCs of one client are warmed one by one, exporting authorizations in bursts floods
+    for dc_id in dc_ids:
+        # Clients removed meanwhile must not get new sessions
+        if multi_clients.get(int(client.name)) is not client:
+            return
+        if int(client.name) in draining_clients:
+            return
+
+        pool = SESSION_POOLS.get((client, dc_id))
+        try:
+            if pool is not None:
+                await pool.ping()
+            else:
+                await get_session_pool(client, dc_id)
+        except Exception as e:
+            logger.warning(
+                f"Failed to warm media session for DC {dc_id} of client {client.name}: {e!r}"
+            )
+
+
+async def warm_session_pools() -> None:
+    """
+    Opens a media session on every bot for every DC the drive files are on, so streams
+    never wait for a session to be set up, then keeps checking them and rebuilds the
+    ones that dropped. Clients added later are warmed on the next round.
+    """
+    from utils.clients import multi_clients, wait_for_clients
+
+    if config.MEDIA_SESSION_CHECK_INTERVAL <= 0:
+        return
+
+    await wait_for_clients()
+    while True:
+        from utils.directoryHandler import DRIVE_DATA
+
+        dc_ids = sorted(DRIVE_DATA.get_dc_ids()) if DRIVE_DATA else []
+        await asyncio.gather(
+            *(
+                warm_client_sessions(client, dc_ids)
+                for client in list(multi_clients.values())
+            )
+        )
+        await asyncio.sleep(config.MEDIA_SESSION_CHECK_INTERVAL)
+
+
+async def get_session_pool(client: Client, dc_id: int) -> MediaSessionPool:
+    """
+    Returns the media session pool of a client for a DC, opening its first session if needed.
+    """
+    global shrink_task
+
+    pool = SESSION_POOLS.get((client, dc_id))
+    if pool is None:
+        pool = MediaSessionPool(client, dc_id)
+        SESSION_POOLS[(client, dc_id)] = pool
+
+    await pool.ensure_session()
+
+    if shrink_task is None:
+        shrink_task = asyncio.create_task(shrink_session_pools())
+    return pool
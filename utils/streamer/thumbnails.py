@@ -0,0 +1,196 @@
+import asyncio, base64, config
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Tuple
+from fastapi.responses import Response
+from pyrogram import raw
+from pyrogram.errors import FileReferenceExpired
+from pyrogram.file_id import FileId, FileType, ThumbnailSource
+from utils.clients import lease_client
+from utils.logger import Logger
+from utils.streamer import get_streamer
+from utils.streamer.chunk_cache import ChunkCache
+from utils.streamer.custom_dl import ByteStreamer
+from utils.streamer.http_range import etag_matches
+from utils.streamer.part_cache import SingleFlight
+
+logger = Logger(__name__)
+
+# Longest side in pixels of the thumbnail served when no size is requested
+DEFAULT_THUMB_SIZE = 320
+
+# Maximum number of files per batch request and thumbnails fetched from Telegram at once
+MAX_BATCH_SIZE = 100
+BATCH_CONCURRENCY = 4
+
+# Telegram thumbnails never change for a media, so they can be cached forever by browsers
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+THUMB_CACHE = ChunkCache(
+    Path(config.THUMB_CACHE_DIR), config.THUMB_CACHE_SIZE, name="thumbnail"
+)
+THUMB_FLIGHTS = SingleFlight()
+
+
+def choose_thumb(thumbs: list, size: int) -> Optional[list]:
+    """
+    Returns the smallest thumbnail whose longest side covers size, otherwise the largest one.
+    """
+    if not thumbs:
+        return None
+    thumbs = sorted(thumbs, key=lambda thumb: max(thumb[1], thumb[2]))
+    for thumb in thumbs:
+        if max(thumb[1], thumb[2]) >= size:
+            return thumb
+    return thumbs[-1]
+
+
+def get_thumb_file_id(file_id: FileId, thumb_size: str) -> FileId:
+    """
+    Builds the FileId of a thumbnail of the media, as pyrogram does for Thumbnail objects.
+    """
+    file_type = (
+        FileType.PHOTO if file_id.file_type == FileType.PHOTO else FileType.THUMBNAIL
+    )
+    return FileId(
+        file_type=file_type,
+        dc_id=file_id.dc_id,
+        media_id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumbnail_file_type=file_type,
+        thumbnail_source=ThumbnailSource.THUMBNAIL,
+        thumbnail_size=thumb_size,
+        volume_id=0,
+        local_id=0,
+    )
+
+
+def get_image_type(data: bytes) -> str:
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return "image/jpeg"
+
+
+async def download_thumb(
+    tg_connect: ByteStreamer, file_id: FileId, thumb: list
+) -> bytes:
+    """
+    Downloads a thumbnail from Telegram, thumbnails are small so they are fetched in one
+    or a few GetFile requests without going through the streaming part caches.
+    """
+    thumb_id = get_thumb_file_id(file_id, thumb[0])
+    media_session = await tg_connect.generate_media_session(tg_connect.client, thumb_id)
+    location = await tg_connect.get_location(thumb_id)
+
+    chunk_size = 1024 * 1024
+    data = b""
+    while True:
+        r = await media_session.invoke(
+            raw.functions.upload.GetFile(
+                location=location, offset=len(data), limit=chunk_size
+            ),
+        )
+        if not isinstance(r, raw.types.upload.File):
+            raise Exception(
+                f"Unexpected GetFile response for media {file_id.media_id}"
+            )
+        data += r.bytes
+        if len(r.bytes) < chunk_size:
+            return data
+
+
+async def get_thumbnail(
+    tg_connect: ByteStreamer, channel: int, file, size: int
+) -> Optional[Tuple[bytes, str]]:
+    """
+    Returns the (image bytes, etag) of the thumbnail of a drive file closest to size,
+    None when Telegram has no thumbnail for it.
+    """
+    file_id = await tg_connect.get_file_properties(channel, file.file_id, file)
+
+    # Files stored before thumbnails were recorded learn them from their message once
+    if file_id.thumbs is None:
+        file_id = await tg_connect.generate_file_properties(channel, file.file_id)
+
+    thumb = choose_thumb(file_id.thumbs, size)
+    if thumb is None:
+        return None
+
+    key = (file_id.media_id, thumb[1], thumb[2])
+    etag = f'"{file_id.media_id:x}-{thumb[1]}x{thumb[2]}"'
+
+    async def fetch():
+        nonlocal file_id
+        data = await THUMB_CACHE.get(key)
+        if data is not None:
+            return data
+
+        try:
+            data = await download_thumb(tg_connect, file_id, thumb)
+        except FileReferenceExpired:
+            file_id = await tg_connect.refresh_file_properties(file_id)
+            data = await download_thumb(tg_connect, file_id, thumb)
+
+        await THUMB_CACHE.put(key, data)
+        return data
+
+    return await THUMB_FLIGHTS.run(key, fetch), etag
+
+
+def parse_thumb_size(size) -> int:
+    try:
+        return max(1, int(size))
+    except (TypeError, ValueError):
+        return DEFAULT_THUMB_SIZE
+
+
+async def thumb_response(channel: int, file, request) -> Response:
+    size = parse_thumb_size(request.query_params.get("size"))
+    with lease_client(dc_id=getattr(file, "dc_id", None)) as lease:
+        thumbnail = await get_thumbnail(get_streamer(lease.client), channel, file, size)
+    if thumbnail is None:
+        return Response(status_code=404)
+
+    data, etag = thumbnail
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None and etag_matches(if_none_match, etag, weak=True):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=data, media_type=get_image_type(data), headers=headers)
+
+
+async def get_thumbnails(channel: int, files: List[Tuple[str, object]], size) -> dict:
+    """
+    Returns the thumbnails of several drive files as data URIs keyed by path, None for
+    files without a thumbnail.
+    """
+    size = parse_thumb_size(size)
+    files = files[:MAX_BATCH_SIZE]
+
+    # The batch goes to the client with a session for the DC most of the files are on
+    dc_ids = Counter(getattr(file, "dc_id", None) for _, file in files)
+    lease = lease_client(dc_id=dc_ids.most_common(1)[0][0] if dc_ids else None)
+    tg_connect = get_streamer(lease.client)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def get_data_uri(path: str, file) -> Optional[str]:
+        async with semaphore:
+            try:
+                thumbnail = await get_thumbnail(tg_connect, channel, file, size)
+            except Exception as e:
+                logger.warning(f"Failed to get thumbnail of {path}: {e}")
+                return None
+        if thumbnail is None:
+            return None
+        data = thumbnail[0]
+        return f"data:{get_image_type(data)};base64,{base64.b64encode(data).decode()}"
+
+    with lease:
+        data_uris = await asyncio.gather(
+            *(get_data_uri(path, file) for path, file in files)
+        )
+    return {path: data_uri for (path, _), data_uri in zip(files, data_uris)}
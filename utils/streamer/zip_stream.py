@@ -0,0 +1,263 @@
+import asyncio, struct, zlib
+from datetime import datetime
+from typing import List, Tuple
+from urllib.parse import quote
+from utils.clients import lease_client
+from utils.logger import Logger
+from utils.streamer import (
+    LeasedStreamingResponse,
+    get_streamer,
+    yield_range,
+    yield_stream,
+)
+from utils.streamer.scheduler import BULK, STREAM_SCHEDULER, Flow
+
+logger = Logger(__name__)
+
+# Every entry is written as ZIP64 with a data descriptor, so the sizes of all records are fixed
+LOCAL_HEADER_SIZE = 30 + 20  # local file header + ZIP64 extra field
+DATA_DESCRIPTOR_SIZE = 24
+CENTRAL_HEADER_SIZE = 46 + 28  # central directory header + ZIP64 extra field
+END_RECORDS_SIZE = 56 + 20 + 22  # ZIP64 end record + ZIP64 locator + end record
+
+# General purpose flags, sizes and crc follow the data (bit 3) and names are UTF-8 (bit 11)
+ZIP_FLAGS = 0x0808
+ZIP_VERSION = 45
+
+
+def collect_files(folder, prefix: str = "") -> List[Tuple[str, object]]:
+    """
+    Returns the (archive name, File) pairs of every file below a folder, skipping trashed items.
+    """
+    entries = []
+    used_names = set()
+
+    def unique_name(name: str) -> str:
+        candidate, counter = name, 1
+        while candidate.lower() in used_names:
+            stem, dot, ext = name.rpartition(".")
+            if not dot or not stem:
+                stem, ext = name, ""
+            candidate = f"{stem} ({counter}){'.' + ext if ext else ''}"
+            counter += 1
+        used_names.add(candidate.lower())
+        return candidate
+
+    for item in folder.contents.values():
+        if item.trash:
+            continue
+        name = unique_name(prefix + item.name.replace("/", "_"))
+        if item.type == "folder":
+            entries.extend(collect_files(item, name + "/"))
+        else:
+            entries.append((name, item))
+    return entries
+
+
+def get_zip_size(entries: List[Tuple[str, object]]) -> int:
+    """
+    Returns the exact size of the archive, computed from the sizes stored in the drive.
+    """
+    size = END_RECORDS_SIZE
+    for name, file in entries:
+        name_length = len(name.encode())
+        size += LOCAL_HEADER_SIZE + name_length + file.size + DATA_DESCRIPTOR_SIZE
+        size += CENTRAL_HEADER_SIZE + name_length
+    return size
+
+
+def dos_datetime(upload_date: str) -> Tuple[int, int]:
+    try:
+        date = datetime.strptime(upload_date, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        date = datetime(1980, 1, 1)
+    date = max(date, datetime(1980, 1, 1))
+    dos_time = (date.hour << 11) | (date.minute << 5) | (date.second // 2)
+    dos_date = ((date.year - 1980) << 9) | (date.month << 5) | date.day
+    return dos_time, dos_date
+
+
+def local_header(name: bytes, dos_time: int, dos_date: int) -> bytes:
+    return (
+        struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            ZIP_VERSION,
+            ZIP_FLAGS,
+            0,  # stored, no compression
+            dos_time,
+            dos_date,
+            0,
+            0xFFFFFFFF,
+            0xFFFFFFFF,
+            len(name),
+            20,
+        )
+        + name
+        + struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+    )
+
+
+def data_descriptor(crc: int, size: int) -> bytes:
+    return struct.pack("<IIQQ", 0x08074B50, crc, size, size)
+
+
+def central_header(
+    name: bytes, dos_time: int, dos_date: int, crc: int, size: int, offset: int
+) -> bytes:
+    return (
+        struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            0x02014B50,
+            ZIP_VERSION,
+            ZIP_VERSION,
+            ZIP_FLAGS,
+            0,
+            dos_time,
+            dos_date,
+            crc,
+            0xFFFFFFFF,
+            0xFFFFFFFF,
+            len(name),
+            28,
+            0,
+            0,
+            0,
+            0,
+            0xFFFFFFFF,
+        )
+        + name
+        + struct.pack("<HHQQQ", 0x0001, 24, size, size, offset)
+    )
+
+
+def end_records(entries_count: int, directory_size: int, directory_offset: int) -> bytes:
+    zip64_end_offset = directory_offset + directory_size
+    return (
+        struct.pack(
+            "<IQHHIIQQQQ",
+            0x06064B50,
+            44,
+            ZIP_VERSION,
+            ZIP_VERSION,
+            0,
+            0,
+            entries_count,
+            entries_count,
+            directory_size,
+            directory_offset,
+        )
+        + struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1)
+        + struct.pack(
+            "<IHHHHIIH", 0x06054B50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0
+        )
+    )
+
+
+async def open_file(tg_connect, channel: int, file, flow: Flow):
+    """
+    Starts streaming a file and waits for its first chunk, returns (first chunk, generator).
+    """
+    if file.size == 0:
+        return b"", None
+
+    file_id = await tg_connect.get_file_properties(channel, file.file_id, file)
+    body = yield_range(tg_connect, file_id, 0, file.size - 1, [], flow=flow)
+    try:
+        first_chunk = await body.__anext__()
+    except StopAsyncIteration:
+        first_chunk = b""
+    return first_chunk, body
+
+
+async def yield_zip(
+    tg_connect, channel: int, entries: List[Tuple[str, object]], flow: Flow
+):
+    """
+    Yields a stored ZIP64 archive of the entries. The next file is opened while the
+    current one is streaming so there is no gap between files.
+    """
+    central_directory = []
+    offset = 0
+    next_file = None
+
+    try:
+        for index, (name, file) in enumerate(entries):
+            encoded_name = name.encode()
+            dos_time, dos_date = dos_datetime(file.upload_date)
+
+            header = local_header(encoded_name, dos_time, dos_date)
+            yield header
+
+            if next_file is None:
+                next_file = asyncio.create_task(
+                    open_file(tg_connect, channel, file, flow)
+                )
+            first_chunk, body = await next_file
+            next_file = None
+
+            # Prefetch the next file while this one is streaming
+            if index + 1 < len(entries):
+                next_file = asyncio.create_task(
+                    open_file(tg_connect, channel, entries[index + 1][1], flow)
+                )
+
+            crc = zlib.crc32(first_chunk)
+            written = len(first_chunk)
+            if first_chunk:
+                yield first_chunk
+            if body is not None:
+                async for chunk in body:
+                    crc = zlib.crc32(chunk, crc)
+                    written += len(chunk)
+                    yield chunk
+
+            if written != file.size:
+                raise Exception(
+                    f"Size mismatch for '{name}', expected {file.size} got {written} bytes"
+                )
+
+            yield data_descriptor(crc, written)
+            central_directory.append(
+                central_header(encoded_name, dos_time, dos_date, crc, written, offset)
+            )
+            offset += len(header) + written + DATA_DESCRIPTOR_SIZE
+
+        directory = b"".join(central_directory)
+        yield directory
+        yield end_records(len(entries), len(directory), offset)
+    finally:
+        if next_file is not None:
+            next_file.cancel()
+            try:
+                _, body = await next_file
+                if body is not None:
+                    await body.aclose()
+            except (asyncio.CancelledError, Exception):
+                pass
+        logger.info(f"Finished zip stream of {len(central_directory)} files")
+
+
+async def zip_streamer(channel: int, folder) -> LeasedStreamingResponse:
+    entries = collect_files(folder)
+    zip_name = ("drive" if folder.name == "/" else folder.name) + ".zip"
+
+    zip_size = get_zip_size(entries)
+    lease = lease_client(size=zip_size)
+    tg_connect = get_streamer(lease.client)
+
+    # Archives are bulk downloads, playback streams are served first
+    flow = STREAM_SCHEDULER.open_flow(zip_name, BULK)
+
+    body = yield_zip(tg_connect, channel, entries, flow)
+    return LeasedStreamingResponse(
+        content=yield_stream(body, lease),
+        headers={
+            "Content-Type": "application/zip",
+            "Content-Length": str(zip_size),
+            "Content-Disposition": f'attachment; filename="{quote(zip_name)}"',
+        },
+        media_type="application/zip",
+        lease=lease,
+        flow=flow,
+    )
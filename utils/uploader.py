@@ -1,63 +1,158 @@
-from utils.clients import get_client
-from pyrogram import Client
+import aiofiles, asyncio, config, hashlib
+from pathlib import Path
+from typing import AsyncIterator, List
+from utils.client_health import get_health
+from utils.clients import lease_client, wait_for_clients
+from utils.part_uploader import UPLOAD_PART_SIZE, PartUploader
+from pyrogram import Client, raw
+from pyrogram.errors import FloodWait
 from pyrogram.types import Message
 from config import STORAGE_CHANNEL
 import os
+from utils.content_hash import (
+    find_duplicate,
+    get_sha256_key,
+    get_unique_id_key,
+    hash_file,
+)
 from utils.logger import Logger
+from utils.streamer.file_properties import get_media_from_message, get_media_properties
 from urllib.parse import unquote_plus
 
 logger = Logger(__name__)
 PROGRESS_CACHE = {}
 STOP_TRANSMISSION = []
 
+# Clients an upload is tried on before it fails
+UPLOAD_ATTEMPTS = 3
 
-async def progress_callback(current, total, id, client: Client, file_path):
-    global PROGRESS_CACHE, STOP_TRANSMISSION
+# Upload slots of every client, by client name
+UPLOAD_SLOTS = {}
+
+
+def get_upload_slots(client: Client) -> asyncio.Semaphore:
+    """
+    Returns the semaphore limiting the uploads a client sends at once to UPLOADS_PER_CLIENT.
+    """
+    slots = UPLOAD_SLOTS.get(client.name)
+    if slots is None:
+        slots = asyncio.Semaphore(config.UPLOADS_PER_CLIENT)
+        UPLOAD_SLOTS[client.name] = slots
+    return slots
+
+
+class UploadCanceled(Exception):
+    pass
+
+
+async def save_file(client: Client, file_path, id, file_size):
+    """
+    Uploads a file from disk in parallel parts and returns its InputFile.
+    """
+    uploader = PartUploader(
+        client,
+        Path(file_path).name,
+        file_size,
+        on_progress=lambda current, total: PROGRESS_CACHE.update(
+            {id: ("running", current, total)}
+        ),
+        restartable=True,
+    )
+    try:
+        await uploader.start()
+        async with aiofiles.open(file_path, "rb") as file:
+            for file_part in range(uploader.total_parts):
+                if id in STOP_TRANSMISSION:
+                    raise UploadCanceled(f"Upload {id} canceled")
+                await uploader.put(file_part, await file.read(UPLOAD_PART_SIZE))
+        return await uploader.finish()
+    finally:
+        await uploader.close()
 
-    PROGRESS_CACHE[id] = ("running", current, total)
-    if id in STOP_TRANSMISSION:
-        logger.info(f"Stopping transmission {id}")
-        client.stop_transmission()
-        try:
-            os.remove(file_path)
-        except:
-            pass
+
+def add_uploaded_file(
+    directory_path, filename, message: Message, hashes: List[str] = ()
+) -> int:
+    """
+    Creates the drive file of a storage channel message and indexes its hashes,
+    returns the file size.
+    """
+    from utils.directoryHandler import DRIVE_DATA
+
+    size = get_media_from_message(message).file_size
+    DRIVE_DATA.new_file(
+        directory_path,
+        filename,
+        message.id,
+        size,
+        **get_media_properties(message),
+        hashes=[*hashes, get_unique_id_key(message)],
+    )
+    return size
 
 
 async def start_file_uploader(
-    file_path, id, directory_path, filename, file_size, delete=True
+    file_path, id, directory_path, filename, file_size, delete=True, content_hash=None
 ):
     global PROGRESS_CACHE
-    from utils.directoryHandler import DRIVE_DATA
 
     logger.info(f"Uploading file {file_path} {id}")
 
-    if file_size > 1.98 * 1024 * 1024 * 1024:
-        # Use premium client for files larger than 2 GB
-        client: Client = get_client(premium_required=True)
-    else:
-        client: Client = get_client()
-
     PROGRESS_CACHE[id] = ("running", 0, 0)
+    filename = unquote_plus(filename)
 
-    message: Message = await client.send_document(
-        STORAGE_CHANNEL,
-        file_path,
-        progress=progress_callback,
-        progress_args=(id, client, file_path),
-        disable_notification=True,
-    )
-    size = (
-        message.photo
-        or message.document
-        or message.video
-        or message.audio
-        or message.sticker
-    ).file_size
+    # Files staged without a hash (chunked uploads, URL imports) are hashed here
+    if content_hash is None and config.DEDUPLICATE_UPLOADS:
+        content_hash = await asyncio.to_thread(hash_file, file_path)
 
-    filename = unquote_plus(filename)
+    duplicate = await find_duplicate([content_hash])
+    if duplicate:
+        size = add_uploaded_file(directory_path, filename, duplicate, [content_hash])
+        PROGRESS_CACHE[id] = ("completed", size, size)
+        logger.info(f"Linked upload {id} to the identical message {duplicate.id}")
+        if delete:
+            Path(file_path).unlink(missing_ok=True)
+        return
 
-    DRIVE_DATA.new_file(directory_path, filename, message.id, size)
+    # Use premium client for files larger than 2 GB
+    premium_required = file_size > 1.98 * 1024 * 1024 * 1024
+    if premium_required:
+        # Premium clients start in the background after the first bot
+        await wait_for_clients()
+
+    # A long flood wait takes the client out of rotation and the upload restarts on another one
+    try:
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            with lease_client(premium_required, size=file_size) as lease:
+                client: Client = lease.client
+                health = get_health(client)
+                try:
+                    async with get_upload_slots(client):
+                        await health.wait_available()
+                        await health.pace("upload")
+                        input_file = await save_file(client, file_path, id, file_size)
+                        message = await send_uploaded_file(
+                            client, input_file, Path(file_path).name
+                        )
+                    health.record_success()
+                    break
+                except FloodWait as e:
+                    health.record_error(e)
+                    if attempt == UPLOAD_ATTEMPTS:
+                        raise
+                    logger.warning(
+                        f"Client {client.name} flood waited {e.value}s, retrying upload {id}"
+                    )
+    except UploadCanceled:
+        logger.info(f"Stopping transmission {id}")
+        if delete:
+            try:
+                os.remove(file_path)
+            except:
+                pass
+        return
+
+    size = add_uploaded_file(directory_path, filename, message, [content_hash])
     PROGRESS_CACHE[id] = ("completed", size, size)
 
     logger.info(f"Uploaded file {file_path} {id}")
@@ -67,3 +162,128 @@ async def start_file_uploader(
             os.remove(file_path)
         except Exception as e:
             pass
+
+
+async def save_stream(
+    client: Client, body: AsyncIterator[bytes], id, filename, file_size, hasher=None
+):
+    """
+    Uploads the bytes of body to Telegram as they arrive and returns the InputFile.
+    At most UPLOAD_STREAM_BUFFER of received parts are in flight, a slower Telegram leg
+    slows down reading the body instead of filling memory. The parts can not be read
+    again, so flood waits are always slept through. The received bytes are fed to hasher.
+    """
+    uploader = PartUploader(
+        client,
+        filename,
+        file_size,
+        on_progress=lambda current, total: PROGRESS_CACHE.update(
+            {id: ("running", current, total)}
+        ),
+        max_window=config.UPLOAD_STREAM_BUFFER // UPLOAD_PART_SIZE,
+    )
+    try:
+        await uploader.start()
+        buffer = bytearray()
+        file_part = 0
+        received = 0
+        async for chunk in body:
+            if id in STOP_TRANSMISSION:
+                raise UploadCanceled(f"Upload {id} canceled")
+            received += len(chunk)
+            if received > file_size:
+                raise ValueError(f"Received more than the {file_size} bytes announced")
+            if hasher:
+                hasher.update(chunk)
+            buffer += chunk
+            while len(buffer) >= UPLOAD_PART_SIZE:
+                await uploader.put(file_part, bytes(buffer[:UPLOAD_PART_SIZE]))
+                del buffer[:UPLOAD_PART_SIZE]
+                file_part += 1
+
+        if received != file_size:
+            raise ValueError(f"Received {received} of the {file_size} bytes announced")
+        if buffer:
+            await uploader.put(file_part, bytes(buffer))
+        return await uploader.finish()
+    finally:
+        await uploader.close()
+
+
+async def send_uploaded_file(client: Client, input_file, filename) -> Message:
+    """
+    Sends an uploaded file to the storage channel as a document.
+    """
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=client.guess_mime_type(filename) or "application/octet-stream",
+        file=input_file,
+        attributes=[raw.types.DocumentAttributeFilename(file_name=filename)],
+    )
+    r = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(STORAGE_CHANNEL),
+            media=media,
+            message="",
+            random_id=client.rnd_id(),
+            silent=True,
+        )
+    )
+    for update in r.updates:
+        if isinstance(
+            update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)
+        ):
+            return await Message._parse(
+                client,
+                update.message,
+                {user.id: user for user in r.users},
+                {chat.id: chat for chat in r.chats},
+            )
+    raise Exception("Telegram did not return the uploaded message")
+
+
+async def stream_file_uploader(
+    body: AsyncIterator[bytes], id, directory_path, filename, file_size
+):
+    """
+    Uploads a file to Telegram while it is being received, nothing is written to disk.
+    The hash is only known at the end, so a streamed duplicate is still uploaded but
+    later copies of it are linked to its message.
+    """
+    logger.info(f"Streaming upload {id} of {filename}")
+
+    if file_size <= 0:
+        raise ValueError("File size equals to 0 B")
+
+    # Use premium client for files larger than 2 GB
+    premium_required = file_size > 1.98 * 1024 * 1024 * 1024
+    if premium_required:
+        # Premium clients start in the background after the first bot
+        await wait_for_clients()
+
+    PROGRESS_CACHE[id] = ("running", 0, file_size)
+
+    # A failed, canceled or disconnected upload reports an error like the job queue does
+    try:
+        # The parts are saved on one account, so a streamed upload can not move to another client
+        with lease_client(premium_required, size=file_size) as lease:
+            client: Client = lease.client
+            health = get_health(client)
+            async with get_upload_slots(client):
+                await health.wait_available()
+                await health.pace("upload")
+                hasher = hashlib.sha256()
+                input_file = await save_stream(
+                    client, body, id, filename, file_size, hasher
+                )
+                message = await send_uploaded_file(client, input_file, filename)
+
+        size = add_uploaded_file(
+            directory_path, filename, message, [get_sha256_key(hasher)]
+        )
+    except BaseException:
+        PROGRESS_CACHE[id] = ("error", 0, 0)
+        raise
+
+    PROGRESS_CACHE[id] = ("completed", size, size)
+
+    logger.info(f"Uploaded file {filename} {id}")
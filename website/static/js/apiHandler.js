@@ -107,6 +107,9 @@ async function getFolderShareAuth(path) {
 // File Uploader Start
 
 const MAX_FILE_SIZE = MAX_FILE_SIZE__SDGJDG // Will be replaced by the python
+const STREAM_UPLOADS = STREAM_UPLOADS__SDGJDG // Will be replaced by the python
+const UPLOAD_CHUNK_CONCURRENCY = UPLOAD_CHUNK_CONCURRENCY__SDGJDG // Will be replaced by the python
+const UPLOAD_CHUNK_ATTEMPTS = 5;
 
 const fileInput = document.getElementById('fileInput');
 const progressBar = document.getElementById('progress-bar');
@@ -115,6 +118,7 @@ const uploadPercent = document.getElementById('upload-percent');
 let uploadRequest = null;
 let uploadStep = 0;
 let uploadID = null;
+let chunkRequests = new Set();
 
 fileInput.addEventListener('change', async (e) => {
     const file = fileInput.files[0];
@@ -134,18 +138,163 @@ fileInput.addEventListener('change', async (e) => {
     document.getElementById('upload-filesize').innerText = 'Filesize: ' + (file.size / (1024 * 1024)).toFixed(2) + ' MB';
     document.getElementById('upload-status').innerText = 'Status: Uploading To Backend Server';
 
+    if (STREAM_UPLOADS) {
+        uploadFileStream(file);
+        return;
+    }
+
+    uploadFileChunks(file);
+});
+
+// Uploads the file in chunks, several at once. The upload id is remembered for the file,
+// so picking the same file again after a failure only sends the chunks still missing
+async function uploadFileChunks(file) {
+    const path = getCurrentPath();
+    const uploadKey = ['chunked-upload', path, file.name, file.size, file.lastModified].join(':');
+
+    const upload = await postJson('/api/uploadInit', {
+        'id': localStorage.getItem(uploadKey),
+        'path': path,
+        'filename': file.name,
+        'size': file.size
+    });
+    if (upload.status !== 'ok') {
+        alert('Upload failed: ' + upload.status);
+        window.location.reload();
+        return;
+    }
+    localStorage.setItem(uploadKey, upload.id);
+
+    uploadStep = 1;
+    uploadID = upload.id;
+
+    const chunkSize = upload.chunk_size;
+    const pending = upload.missing.slice();
+    const chunkProgress = {};
+    const resumedBytes = file.size - pending.reduce((total, index) => total + chunkLength(file, chunkSize, index), 0);
+    let uploadedBytes = resumedBytes;
+
+    const showProgress = () => {
+        const inFlight = Object.values(chunkProgress).reduce((total, loaded) => total + loaded, 0);
+        const percentComplete = file.size === 0 ? 100 : ((uploadedBytes + inFlight) / file.size) * 100;
+        progressBar.style.width = percentComplete + '%';
+        uploadPercent.innerText = 'Progress : ' + percentComplete.toFixed(2) + '%';
+    };
+    showProgress();
+
+    const worker = async () => {
+        while (pending.length > 0) {
+            const index = pending.shift();
+            await uploadChunk(file, upload.id, chunkSize, index, (loaded) => {
+                chunkProgress[index] = loaded;
+                showProgress();
+            });
+            delete chunkProgress[index];
+            uploadedBytes += chunkLength(file, chunkSize, index);
+            showProgress();
+        }
+    };
+
+    try {
+        const workers = [];
+        for (let i = 0; i < Math.min(UPLOAD_CHUNK_CONCURRENCY, pending.length); i++) {
+            workers.push(worker());
+        }
+        await Promise.all(workers);
+
+        const json = await postJson('/api/uploadFinalize', { 'id': upload.id });
+        if (json.status !== 'ok') {
+            throw new Error(json.status);
+        }
+    } catch (err) {
+        if (uploadStep !== 1) {
+            return;
+        }
+        pending.length = 0;
+        chunkRequests.forEach((request) => request.abort());
+        alert('Upload failed: ' + err.message + '\nSelect the same file again to resume it');
+        window.location.reload();
+        return;
+    }
+
+    localStorage.removeItem(uploadKey);
+    uploadStep = 2;
+    await handleUpload2(upload.id);
+}
+
+function chunkLength(file, chunkSize, index) {
+    return Math.min(chunkSize, file.size - index * chunkSize);
+}
+
+// Sends one chunk, again after a growing delay if it fails. Sending a chunk twice is harmless
+async function uploadChunk(file, id, chunkSize, index, onProgress) {
+    const params = new URLSearchParams({
+        'id': id,
+        'index': index
+    });
+    const chunk = file.slice(index * chunkSize, index * chunkSize + chunkSize);
+
+    for (let attempt = 1; ; attempt++) {
+        try {
+            await putChunk('/api/uploadChunk?' + params.toString(), chunk, onProgress);
+            return;
+        } catch (err) {
+            onProgress(0);
+            if (attempt >= UPLOAD_CHUNK_ATTEMPTS || uploadStep !== 1) {
+                throw err;
+            }
+            await new Promise((resolve) => setTimeout(resolve, 1000 * attempt));
+        }
+    }
+}
+
+function putChunk(url, chunk, onProgress) {
+    return new Promise((resolve, reject) => {
+        const request = new XMLHttpRequest();
+        chunkRequests.add(request);
+        request.open('PUT', url, true);
+        request.setRequestHeader('X-Password', getPassword());
 
-    const formData = new FormData();
-    formData.append('file', file);
-    formData.append('path', getCurrentPath());
-    formData.append('password', getPassword());
+        request.upload.addEventListener('progress', (e) => {
+            if (e.lengthComputable) {
+                onProgress(e.loaded);
+            }
+        });
+
+        request.addEventListener('loadend', () => {
+            chunkRequests.delete(request);
+            let status = request.statusText;
+            try {
+                status = JSON.parse(request.responseText).status;
+            } catch (err) { }
+
+            if (request.status === 200 && status === 'ok') {
+                resolve();
+            } else {
+                reject(new Error(status || 'Network error'));
+            }
+        });
+
+        request.send(chunk);
+    });
+}
+
+// Sends the file straight through the backend to Telegram, the request ends once it is stored
+function uploadFileStream(file) {
     const id = getRandomId();
-    formData.append('id', id);
-    formData.append('total_size', file.size);
+    const params = new URLSearchParams({
+        'path': getCurrentPath(),
+        'id': id,
+        'filename': file.name,
+        'total_size': file.size
+    });
+
+    document.getElementById('upload-status').innerText = 'Status: Uploading To Telegram Server';
 
     uploadStep = 1;
     uploadRequest = new XMLHttpRequest();
-    uploadRequest.open('POST', '/api/upload', true);
+    uploadRequest.open('POST', '/api/uploadStream?' + params.toString(), true);
+    uploadRequest.setRequestHeader('X-Password', getPassword());
 
     uploadRequest.upload.addEventListener('progress', (e) => {
         if (e.lengthComputable) {
@@ -155,8 +304,23 @@ fileInput.addEventListener('change', async (e) => {
         }
     });
 
-    uploadRequest.upload.addEventListener('load', async () => {
-        await updateSaveProgress(id)
+    uploadRequest.upload.addEventListener('load', () => {
+        document.getElementById('upload-status').innerText = 'Status: Processing File On Telegram Server';
+    });
+
+    uploadRequest.addEventListener('load', () => {
+        let status = uploadRequest.statusText;
+        try {
+            const json = JSON.parse(uploadRequest.responseText);
+            status = json.status || json.detail;
+        } catch (err) { }
+
+        if (status === 'ok') {
+            alert('Upload Completed');
+        } else {
+            alert('Upload failed: ' + status);
+        }
+        window.location.reload();
     });
 
     uploadRequest.upload.addEventListener('error', () => {
@@ -164,12 +328,19 @@ fileInput.addEventListener('change', async (e) => {
         window.location.reload();
     });
 
-    uploadRequest.send(formData);
-});
+    uploadRequest.send(file);
+}
 
 cancelButton.addEventListener('click', () => {
     if (uploadStep === 1) {
-        uploadRequest.abort();
+        uploadStep = 0;
+        if (uploadRequest) {
+            uploadRequest.abort();
+        }
+        chunkRequests.forEach((request) => request.abort());
+        if (uploadID) {
+            postJson('/api/cancelUpload', { 'id': uploadID })
+        }
     } else if (uploadStep === 2) {
         const data = { 'id': uploadID }
         postJson('/api/cancelUpload', data)
@@ -238,6 +409,11 @@ async function handleUpload2(id) {
             alert('Upload Completed')
             window.location.reload();
         }
+        else if (data[0] === 'error') {
+            clearInterval(interval);
+            alert('Failed To Upload File To Telegram Server')
+            window.location.reload();
+        }
     }, 3000)
 }
 
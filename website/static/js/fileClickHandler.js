@@ -12,8 +12,14 @@ function openFile() {
     const fileName = this.getAttribute('data-name').toLowerCase()
     let path = '/file?path=' + this.getAttribute('data-path') + '/' + this.getAttribute('data-id')
 
+    // Streams opened from a shared folder count against the shared link bandwidth limit
+    const auth = getFolderAuthFromPath()
+    if (auth) {
+        path = path + '&auth=' + auth
+    }
+
     if (fileName.endsWith('.mp4') || fileName.endsWith('.mkv') || fileName.endsWith('.webm') || fileName.endsWith('.mov') || fileName.endsWith('.avi') || fileName.endsWith('.ts') || fileName.endsWith('.ogv')) {
-        path = '/stream?url=' + getRootUrl() + path
+        path = '/stream?url=' + encodeURIComponent(getRootUrl() + path)
     }
 
     window.open(path, '_blank')
@@ -53,6 +59,10 @@ function openMoreButton(div) {
             moreDiv.querySelector(`#folder-share-${id}`).addEventListener('click', shareFolder)
         }
         catch { }
+        try {
+            moreDiv.querySelector(`#folder-zip-${id}`).addEventListener('click', downloadFolderZip)
+        }
+        catch { }
     }
     else {
         moreDiv.querySelector(`#restore-${id}`).addEventListener('click', restoreFileFolder)
@@ -238,4 +248,10 @@ async function shareFolder() {
     copyTextToClipboard(link)
 }
 
+function downloadFolderZip() {
+    const id = this.getAttribute('id').split('-')[2]
+    const path = document.getElementById(`more-option-${id}`).getAttribute('data-path') + '/' + id
+    window.open(`/zip?path=${path}`, '_blank')
+}
+
 // File More Button Handler  End
@@ -18,12 +18,12 @@ function showDirectory(data) {
                 html += `<div data-path="${item.path}" id="more-option-${item.id}" data-name="${item.name}" class="more-options"><input class="more-options-focus" readonly="readonly" style="height:0;width:0;border:none;position:absolute"><div id="restore-${item.id}" data-path="${item.path}"><img src="static/assets/load-icon.svg"> Restore</div><hr><div id="delete-${item.id}" data-path="${item.path}"><img src="static/assets/trash-icon.svg"> Delete</div></div>`
             }
             else {
-                html += `<div data-path="${item.path}" id="more-option-${item.id}" data-name="${item.name}" class="more-options"><input class="more-options-focus" readonly="readonly" style="height:0;width:0;border:none;position:absolute"><div id="rename-${item.id}"><img src="static/assets/pencil-icon.svg"> Rename</div><hr><div id="move-${item.id}"><img src="static/assets/upload-icon.svg"> Move</div><hr><div id="copy-${item.id}"><img src="static/assets/file-icon.svg"> Copy</div><hr><div id="trash-${item.id}"><img src="static/assets/trash-icon.svg"> Trash</div><hr><div id="folder-share-${item.id}"><img src="static/assets/share-icon.svg"> Share</div></div>`
+                html += `<div data-path="${item.path}" id="more-option-${item.id}" data-name="${item.name}" class="more-options"><input class="more-options-focus" readonly="readonly" style="height:0;width:0;border:none;position:absolute"><div id="rename-${item.id}"><img src="static/assets/pencil-icon.svg"> Rename</div><hr><div id="move-${item.id}"><img src="static/assets/upload-icon.svg"> Move</div><hr><div id="copy-${item.id}"><img src="static/assets/file-icon.svg"> Copy</div><hr><div id="trash-${item.id}"><img src="static/assets/trash-icon.svg"> Trash</div><hr><div id="folder-share-${item.id}"><img src="static/assets/share-icon.svg"> Share</div><hr><div id="folder-zip-${item.id}"><img src="static/assets/link-icon.svg"> Download ZIP</div></div>`
             }
         } else if (item.type === 'file') {
             const size = convertBytes(item.size)
             html += `<tr data-path="${item.path}" data-id="${item.id}" data-name="${item.name}" class="body-tr file-tr">
-                <td><div class="td-align"><img src="static/assets/file-icon.svg"><span>${item.name}</span></div></td>
+                <td><div class="td-align"><img src="static/assets/file-icon.svg" id="thumb-${item.id}"><span>${item.name}</span></div></td>
                 <td><div class="td-align">${size}</div></td>
                 <td><div class="td-align"><a data-id="${item.id}" class="more-btn"><img src="static/assets/more-icon.svg" class="rotate-90"></a></div></td>
             </tr>`
@@ -38,6 +38,10 @@ function showDirectory(data) {
     }
     document.getElementById('directory-data').innerHTML = html
 
+    if (!isTrash) {
+        loadThumbnails(data)
+    }
+
     if (!isTrash) {
         document.querySelectorAll('.folder-tr').forEach(div => {
             div.ondblclick = openFolder;
@@ -60,6 +64,35 @@ function showDirectory(data) {
     }
 }
 
+async function loadThumbnails(data) {
+    // Files known to have no thumbnail keep the generic icon
+    const files = Object.values(data).filter(item => item.type === 'file' && item.thumb !== false)
+    if (files.length === 0) {
+        return
+    }
+
+    const paths = {}
+    files.forEach(item => paths[item.path + '/' + item.id] = item.id)
+
+    // The server answers at most 100 files per request
+    const allPaths = Object.keys(paths)
+    for (let i = 0; i < allPaths.length; i += 100) {
+        try {
+            const json = await postJson('/api/getThumbnails', { 'paths': allPaths.slice(i, i + 100), 'size': 64 })
+            for (const [path, dataUri] of Object.entries(json.data)) {
+                const img = document.getElementById(`thumb-${paths[path]}`)
+                if (dataUri && img) {
+                    img.src = dataUri
+                    img.classList.add('file-thumb')
+                }
+            }
+        }
+        catch (err) {
+            console.log(err)
+        }
+    }
+}
+
 document.getElementById('search-form').addEventListener('submit', async (event) => {
     event.preventDefault();
     const query = document.getElementById('file-search').value;